@@ -7,4 +7,5 @@ Created on 17:46:01 2016-10-21
 http://github.com/heshenghuan
 """
 
-__all__ = ['kdtree', 'knn', 'Distance']
+__all__ = ['kdtree', 'knn', 'Distance', 'pointbuffer', 'lsh', 'shard',
+           'aioknn', 'ingest', 'projection']
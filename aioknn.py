@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asyncio front end for KNN models.
+
+A MicroBatcher collects the classify requests made concurrently on an event
+loop into micro-batches, and runs every batch with the model's
+classify_batch() on an executor, so the event loop is never blocked by a
+tree search. A batch is started when it has max_batch requests, or
+max_delay seconds after its first request.
+
+The searches of a KNN are pure Python, threads would run them one at a time,
+so with processes set every batch is split over a pool of processes that
+each hold a copy of the model. A shard.ShardedKNN already searches in its
+shard processes, a thread is enough to wait for them.
+
+A request that fails (e.g. a malformed point) only fails its own future, the
+other requests of its batch still get their results.
+
+Works with any model that has classify_batch(), i.e. knn.KNN and
+shard.ShardedKNN. Requires Python 3.
+"""
+
+import asyncio
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import dill
+
+# the model of a pool process
+_model = None
+
+
+def _load(payload):
+    global _model
+    _model = dill.loads(payload)
+
+
+def _classify_each(model, points, k, dist, prbout):
+    """
+    Classifies points with model.classify_batch(), if that fails every point
+    is classified on its own, so an error only affects the point causing it.
+
+    Returns one (error, result) tuple per point, error is None on success.
+    """
+    try:
+        return [(None, result) for result in
+                model.classify_batch(points, k, dist, prbout)]
+    except Exception:
+        if len(points) == 1:
+            return [(sys.exc_info()[1], None)]
+
+    results = []
+    for point in points:
+        try:
+            results.append(
+                (None, model.classify_batch([point], k, dist, prbout)[0]))
+        except Exception:
+            results.append((sys.exc_info()[1], None))
+    return results
+
+
+def _classify_batch(payload):
+    points, k, dist, prbout = dill.loads(payload)
+    return _classify_each(_model, points, k, dist, prbout)
+
+
+class MicroBatcher(object):
+    """
+    Batches concurrent classify requests of a model.
+    """
+
+    def __init__(self, model, max_batch=64, max_delay=0.002, executor=None,
+                 processes=None):
+        """
+        Creates a batcher for model.
+
+        max_batch is the largest number of requests in one batch, max_delay
+        the longest time in seconds a request waits for its batch to fill.
+
+        executor is the concurrent.futures executor batches are run on, by
+        default the event loop's default executor (a thread pool).
+
+        If processes is given (and no executor), batches are split over a
+        pool of that many processes instead. Each process loads a copy of
+        the model when the pool starts, so the pool costs processes times
+        the memory of the model, until close() is called. Samples added to
+        the model later are not seen by the pool, a new batcher is needed.
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.executor = executor
+        self.processes = None
+        if executor is None and processes:
+            self.processes = processes
+            self.executor = ProcessPoolExecutor(
+                processes, initializer=_load, initargs=(dill.dumps(model),))
+        # maps (k, dist, prbout) to the list of (point, future) waiting
+        self._pending = {}
+        self._timers = {}
+        self.stats = {
+            'queue_depth': 0,
+            'in_flight': 0,
+            'requests': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+        }
+
+    def mean_batch_size(self):
+        """
+        Returns the average number of requests per batch.
+        """
+        if not self.stats['batches']:
+            return 0.0
+        return float(self.stats['requests'] -
+                     self.stats['queue_depth']) / self.stats['batches']
+
+    def classify(self, point=None, k=1, dist=None, prbout=0):
+        """
+        Queues a classify request, see KNN.classify().
+
+        Must be called from a running event loop. Returns a future resolved
+        with the result once its batch has run.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if not point:
+            future.set_result([])
+            return future
+
+        key = (k, dist, prbout)
+        batch = self._pending.setdefault(key, [])
+        batch.append((point, future))
+        self.stats['requests'] += 1
+        self.stats['queue_depth'] += 1
+
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.max_delay, self._flush,
+                                                key)
+        return future
+
+    def _flush(self, key):
+        """
+        Starts the batch waiting under key on the executor.
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if not batch:
+            return
+
+        size = len(batch)
+        self.stats['queue_depth'] -= size
+        self.stats['in_flight'] += size
+        self.stats['batches'] += 1
+        self.stats['last_batch_size'] = size
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], size)
+
+        k, dist, prbout = key
+        points = [point for point, future in batch]
+        loop = asyncio.get_event_loop()
+        if self.processes is None:
+            parts = [loop.run_in_executor(self.executor, _classify_each,
+                                          self.model, points, k, dist,
+                                          prbout)]
+        else:
+            # one part of the batch for every process
+            step = -(-len(points) // self.processes)
+            parts = [loop.run_in_executor(
+                self.executor, _classify_batch,
+                dill.dumps((points[i:i + step], k, dist, prbout)))
+                for i in range(0, len(points), step)]
+        done = asyncio.gather(*parts)
+        done.add_done_callback(lambda d: self._resolve(batch, d))
+
+    def _resolve(self, batch, done):
+        """
+        Sets the results of a finished batch on the futures of its requests.
+        """
+        self.stats['in_flight'] -= len(batch)
+        if done.cancelled():
+            for point, future in batch:
+                future.cancel()
+            return
+        error = done.exception()
+        if error is not None:
+            # the executor failed, not a request
+            for point, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        results = [result for part in done.result() for result in part]
+        for (point, future), (error, result) in zip(batch, results):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """
+        Starts the batches still waiting and shuts the process pool of the
+        batcher down, once they have run. The batcher can not be used after
+        that.
+        """
+        for key in list(self._pending):
+            self._flush(key)
+        if self.processes is not None:
+            self.executor.shutdown(wait=False)
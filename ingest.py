@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming construction of KNN models.
+
+The readers yield (values, label) samples one at a time, values being the
+list of the point's values on all dimensions. A Builder appends them straight
+into a PointBuffer, so neither dict points nor a full copy of the data are
+ever held in memory; with spill set the buffer itself lives in a
+memory-mapped file.
+
+    builder = Builder(dimensions=128, storage='int8', spill='train.buf')
+    builder.feed(iter_csv('train.csv', label_type=int))
+    model = builder.build()
+"""
+
+import csv
+
+import knn
+from pointbuffer import PointBuffer
+
+
+def iter_csv(path, label_column=-1, delimiter=',', skip_header=False,
+             label_type=None):
+    """
+    Yields the (values, label) samples of a CSV file, row by row.
+
+    label_column is the index of the label in a row, the other columns are
+    the values. label_type converts the label (e.g. int), by default it is
+    kept as a string.
+    """
+    with open(path) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        if skip_header:
+            next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            label = row.pop(label_column)
+            if label_type is not None:
+                label = label_type(label)
+            yield [float(v) for v in row], label
+
+
+def iter_npy(path, labels=None, label_column=-1):
+    """
+    Yields the (values, label) samples of a 2-d .npy array, row by row.
+
+    The array is memory-mapped, not loaded. If labels is given it is the
+    path of a 1-d .npy array of labels, otherwise the labels are the column
+    label_column of the array.
+
+    Requires numpy.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('iter_npy requires numpy')
+
+    data = numpy.load(path, mmap_mode='r')
+    if labels is not None:
+        labels = numpy.load(labels, mmap_mode='r')
+        for i in range(data.shape[0]):
+            yield data[i].tolist(), labels[i].item()
+        return
+
+    column = label_column % data.shape[1]
+    for i in range(data.shape[0]):
+        # only this row is read from the file
+        row = data[i].tolist()
+        label = row.pop(column)
+        yield row, label
+
+
+class Builder(object):
+    """
+    Builds a KNN model from a stream of samples.
+    """
+
+    def __init__(self, dimensions, storage='float32', rerank=None,
+                 spill=None, memory_limit=1 << 20, calibrate=10000):
+        """
+        Creates a builder for points of the given dimensions.
+
+        storage and rerank are those of the KNN model, see KNN.__init__().
+        spill and memory_limit are passed to the PointBuffer, see
+        PointBuffer.__init__().
+
+        int8/int16 storages need a scale before the first point is stored,
+        it is fitted on the first calibrate samples, values of later samples
+        outside that range are clipped.
+        """
+        self.buffer = PointBuffer(dimensions, storage, exact=bool(rerank),
+                                  spill=spill, memory_limit=memory_limit)
+        self.storage = storage
+        self.rerank = rerank
+        self.calibrate = calibrate
+        self.train_label = []
+        self._calibration = None
+        if self.buffer.qmax is not None:
+            self._calibration = []
+
+    def _values(self, point):
+        if hasattr(point, 'keys'):
+            return [point.get(axis, 0.)
+                    for axis in range(self.buffer.dimensions)]
+        return point
+
+    def _store(self, samples):
+        for values, label in samples:
+            self.buffer.append_values(values)
+            self.train_label.append(label)
+
+    def _calibrate(self):
+        """
+        Fits the buffer on the held back samples and stores them.
+        """
+        samples, self._calibration = self._calibration, None
+        self.buffer.fit_values(values for values, label in samples)
+        self._store(samples)
+
+    def feed(self, samples):
+        """
+        Adds an iterable of (point, label) samples, a point is either a dict
+        or the sequence of its values on all dimensions.
+        """
+        for point, label in samples:
+            sample = (self._values(point), label)
+            if self._calibration is None:
+                self._store([sample])
+            else:
+                self._calibration.append(sample)
+                if len(self._calibration) >= self.calibrate:
+                    self._calibrate()
+
+    def build(self, **params):
+        """
+        Returns the KNN model of all the samples fed, params are the other
+        keyword arguments of KNN (axis, sel_axis, index, index_params).
+        """
+        if self._calibration is not None:
+            self._calibrate()
+        self.buffer.freeze()
+        return knn.KNN(self.buffer, self.train_label, storage=self.storage,
+                       rerank=self.rerank, **params)
@@ -9,6 +9,7 @@ from __future__ import print_function
 import math
 import operator
 import dill
+from array import array
 from functools import wraps
 from collections import deque
 
@@ -21,6 +22,26 @@ COMPARE_CHILD = {
 }
 
 
+# ranges of a BufferTree up to this size are sorted, larger ones are
+# partitioned in place
+SORT_LIMIT = 1 << 16
+
+
+def _offer(results, key, dist, k):
+    """
+    Adds key at dist to results, a dict of the k nearest found so far, if
+    it is among them, and drops the ones that are not any more. Keys at the
+    k-th distance are all kept.
+    """
+    if len(results) < k or dist <= max(results.values()):
+        results[key] = dist
+        if len(results) > k:
+            kthDist = sorted(results.values())[k - 1]
+            for other, d in list(results.items()):
+                if d > kthDist:
+                    results.pop(other)
+
+
 def require_axis(f):
     """ Check if the object of the function has axis and sel_axis members """
     @wraps(f)
@@ -123,7 +144,7 @@ class KDNode:
         """
         current = self
         while True:
-            check_dimensionality(point, dimensions=current.dimensions)
+            check_dimensionality([point], dimensions=current.dimensions)
 
             # Adding has hit an empty leaf-node, add here
             if current.data is None:
@@ -278,62 +299,29 @@ class KDNode:
         r = range(len(self.data))
         return sum([self.axis_dist(point, i) for i in r])
 
-    def _search_node(self, point, k, results, examined, get_dist):
+    def _search_node(self, point, k, results, examined, get_dist, radius):
         """
         k is the number of nearest neighbors of point.
 
-        results is an ordered dict, while the key-value pair is
-        (node, distance).
+        results is a dict, while the key-value pair is (node, distance).
 
         examined is a set.
 
         get_dist is a distance function, expecting two points and returning a
         distance value. Distance values can be any compareable type.
+
+        radius(d) converts a distance to the largest difference on one axis
+        two points at that distance can have, the sqrt for the squared
+        Euclidean distance.
         """
         examined.add(self)
 
-        # Get current best
-        if not results:
-            # results is empty
-            bestNode = None
-            bestDist = float('inf')
-        else:
-            # find the nearest (node, distance) tuple
-            bestNode, bestDist = sorted(
-                results.items(), key=lambda n_d: n_d[1], reverse=False)[0]
-
-        nodesChanged = False
-
-        # If the current node is closer than the current best, then it becomes
-        # the current best. And the maximum distance nodes should be removed.
-        nodeDist = get_dist(self)
-        if nodeDist < bestDist:
-            if len(results) == k and bestNode:
-                # results.pop(bestNode)
-                # here is the difference, i remove the max dist node
-                maxNode, maxDist = sorted(
-                    results.items(), key=lambda n: n[1], reverse=True)[0]
-                results.pop(maxNode)
-
-            results[self] = nodeDist
-            nodesChanged = True
-        # If we're equal to the current best, add it, regardless of k
-        elif nodeDist == bestDist:
-            results[self] = nodeDist
-            nodesChanged = True
-        # If we don't have k results yet, add it anyway
-        elif len(results) < k:
-            results[self] = nodeDist
-            nodesChanged = True
-
-        # Get new best only if nodes have changed
-        if nodesChanged:
-            bestNode, bestDist = sorted(
-                results.items(), key=lambda n: n[1], reverse=False)[0]
+        _offer(results, self, get_dist(self), k)
 
         # Check whether there could be any other points on the other side
         # of the splitting.
-        # hyperplane that are closer to the search point than the current best.
+        # hyperplane that are closer to the search point than the current
+        # k-th nearest.
         for child, pos in self.children():
             if child in examined:
                 continue
@@ -341,13 +329,18 @@ class KDNode:
             examined.add(child)
             compare, combine = COMPARE_CHILD[pos]
 
+            if len(results) < k:
+                kthDist = float('inf')
+            else:
+                kthDist = radius(max(results.values()))
+
             # Since the hyperplanes are all axis-aligned this is implemented
             # as a simple comparison to see whether the difference between the
             # splitting coordinate of the search point and current node is less
             # than the distance (overall coordinates) from the search point to
-            # the current best.
+            # the current k-th nearest.
             nodePoint = self.data.get(self.axis, 0.)
-            pointPlusDist = combine(point.get(self.axis, 0.), bestDist)
+            pointPlusDist = combine(point.get(self.axis, 0.), kthDist)
             lineIntersects = compare(pointPlusDist, nodePoint)
 
             # If the hypersphere crosses the plane, there could be nearer
@@ -356,7 +349,8 @@ class KDNode:
             # for closer points, following the same recursive process as the
             # entire search.
             if lineIntersects:
-                child._search_node(point, k, results, examined, get_dist)
+                child._search_node(point, k, results, examined, get_dist,
+                                   radius)
 
     def search_knn(self, point, k, dist=None):
         """
@@ -369,7 +363,10 @@ class KDNode:
         distance.
 
         dist is a distance function, expecting two points and returning a
-        distance value. Distance values can be any compareable type.
+        distance value. Distance values can be any compareable type. Subtrees
+        are pruned assuming dist is never smaller than the difference of the
+        points on any one axis, as for all Minkowski distances with p >= 1.
+        By default it is the squared Euclidean distance.
 
         The result is an ordered list of (node,distance) tuples.
         """
@@ -378,8 +375,10 @@ class KDNode:
 
         if dist is None:
             get_dist = lambda n: n.dist(point)
+            radius = math.sqrt
         else:
             get_dist = lambda n: dist(n.data, point)
+            radius = lambda d: d
 
         # go down the trees as we would for inserting
         while current:
@@ -402,7 +401,8 @@ class KDNode:
         # Go uo the tree, looking for better solutions
         current = prev
         while current:
-            current._search_node(point, k, results, examined, get_dist)
+            current._search_node(point, k, results, examined, get_dist,
+                                 radius)
             current = current.parent
 
         return sorted(results.items(), key=lambda a: a[1])
@@ -426,6 +426,197 @@ class KDNode:
         return id(self)
 
 
+class BufferNode(object):
+    """
+    A point of a BufferTree, as returned by its search_knn().
+
+    index is the position of the point in the buffer.
+    """
+
+    __slots__ = ('data', 'index')
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    def __repr__(self):
+        return "<%(cls)s - %(data)s>" % dict(cls=self.__class__.__name__,
+                                             data=repr(self.data))
+
+
+class BufferTree(object):
+    """
+    A kd-tree over the points of a pointbuffer.PointBuffer, kept in a single
+    array of point indices instead of KDNode objects.
+
+    order[lo:hi] is a subtree, its root is the median order[(lo + hi) // 2]
+    on the axis of the subtree, the left subtree is order[lo:mid] and the
+    right one order[mid + 1:hi]. The tree costs 4 bytes per point, the
+    points themselves stay in the buffer, which may be memory-mapped.
+
+    Points added after the tree was built go to a KDNode tree, extra, which
+    is searched as well.
+    """
+
+    def __init__(self, buffer, axis=0, sel_axis=None):
+        """
+        Builds the tree of all points in buffer. axis and sel_axis are the
+        same as for create().
+        """
+        self.buffer = buffer
+        self.dimensions = buffer.dimensions
+        self.axis = axis
+        dimensions = self.dimensions
+        self.sel_axis = sel_axis or (
+            lambda prev_axis: (prev_axis + 1) % dimensions)
+        n = len(buffer)
+        self.order = array('i' if n < 1 << 31 else 'q', range(n))
+        self.extra = None
+        self._build(0, n, axis)
+
+    def _build(self, lo, hi, axis):
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            self._select(lo, hi, mid, axis)
+            self._build(lo, mid, self.sel_axis(axis))
+            lo, axis = mid + 1, self.sel_axis(axis)
+
+    def _select(self, lo, hi, nth, axis):
+        """
+        Reorders order[lo:hi] so the point at nth has the nth smallest value
+        on axis, the ones before it have smaller or equal values, the ones
+        after it larger or equal values.
+        """
+        order = self.order
+        key = lambda i: self.buffer.value(i, axis)
+        # three-way partitions around a median of three, without copying
+        # large ranges
+        while hi - lo > SORT_LIMIT:
+            pivot = sorted([key(order[lo]), key(order[(lo + hi) // 2]),
+                            key(order[hi - 1])])[1]
+            lt, i, gt = lo, lo, hi
+            while i < gt:
+                v = key(order[i])
+                if v < pivot:
+                    order[lt], order[i] = order[i], order[lt]
+                    lt += 1
+                    i += 1
+                elif v > pivot:
+                    gt -= 1
+                    order[gt], order[i] = order[i], order[gt]
+                else:
+                    i += 1
+            if nth < lt:
+                hi = lt
+            elif nth >= gt:
+                lo = gt
+            else:
+                return
+        order[lo:hi] = array(order.typecode, sorted(order[lo:hi], key=key))
+
+    def add(self, point):
+        """
+        Adds a point of the buffer (a BufferPoint view) to the tree, returns
+        its node.
+        """
+        if self.extra is None:
+            self.extra = create([point], self.dimensions, self.axis,
+                                self.sel_axis)
+            node = self.extra
+        else:
+            node = self.extra.add(point)
+        node.index = point.index
+        return node
+
+    def _search(self, lo, hi, axis, point, k, results, get_dist, radius):
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        index = self.order[mid]
+        _offer(results, index, get_dist(index), k)
+        if hi - lo == 1:
+            return
+
+        nodePoint = self.buffer.value(index, axis)
+        value = point.get(axis, 0.)
+        sub_axis = self.sel_axis(axis)
+        if value < nodePoint:
+            near, far, pos = (lo, mid), (mid + 1, hi), 1
+        else:
+            near, far, pos = (mid + 1, hi), (lo, mid), 0
+        self._search(near[0], near[1], sub_axis, point, k, results,
+                     get_dist, radius)
+
+        # the other side, if the k-th nearest sphere crosses the plane
+        if len(results) < k:
+            kthDist = float('inf')
+        else:
+            kthDist = radius(max(results.values()))
+        compare, combine = COMPARE_CHILD[pos]
+        if compare(combine(value, kthDist), nodePoint):
+            self._search(far[0], far[1], sub_axis, point, k, results,
+                         get_dist, radius)
+
+    def search_knn(self, point, k, dist=None):
+        """
+        Returns the k nearest neighbors of the given point and their
+        distance, same as KDNode.search_knn(). The nodes of the points in
+        the buffer are BufferNodes.
+        """
+        buffer = self.buffer
+        if dist is None:
+            get_dist = lambda i: sum(
+                math.pow(buffer.value(i, axis) - point.get(axis, 0.), 2)
+                for axis in range(self.dimensions))
+            radius = math.sqrt
+        else:
+            get_dist = lambda i: dist(buffer[i], point)
+            radius = lambda d: d
+
+        results = {}
+        self._search(0, len(self.order), self.axis, point, k, results,
+                     get_dist, radius)
+        found = [(BufferNode(buffer[i], i), d) for i, d in results.items()]
+        if self.extra is not None:
+            found.extend(self.extra.search_knn(point, k, dist))
+        found.sort(key=lambda n: n[1])
+        if len(found) <= k:
+            return found
+        kthDist = found[k - 1][1]
+        return [(node, d) for node, d in found if d <= kthDist]
+
+    def nodes(self):
+        """
+        Returns the tree as KDNode objects, e.g. for visualize(). They take
+        the memory the BufferTree saves.
+        """
+        def build(lo, hi, axis, parent):
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = KDNode(self.buffer[self.order[mid]], parent, axis=axis,
+                          sel_axis=self.sel_axis, dimensions=self.dimensions)
+            node.index = self.order[mid]
+            node.left = build(lo, mid, self.sel_axis(axis), node)
+            node.right = build(mid + 1, hi, self.sel_axis(axis), node)
+            return node
+
+        root = build(0, len(self.order), self.axis, None)
+        if root is None:
+            root = KDNode(axis=self.axis, sel_axis=self.sel_axis,
+                          dimensions=self.dimensions)
+        if self.extra is not None:
+            for extra in level_order(self.extra):
+                root.add(extra.data).index = extra.index
+        return root
+
+    def __len__(self):
+        n = len(self.order)
+        if self.extra is not None:
+            n += sum(1 for node in level_order(self.extra))
+        return n
+
+
 def create(point_list, dimensions, axis=0, sel_axis=None, parent=None):
     """
     Creates a kd-tree from a list of points
@@ -458,11 +649,11 @@ def create(point_list, dimensions, axis=0, sel_axis=None, parent=None):
 
     # Sort point list and choose median as pivot element
     point_list.sort(key=lambda point: point.get(axis, 0.))
-    median = len(point_list) / 2
+    median = len(point_list) // 2
 
     loc = point_list[median]
     root = KDNode(loc, parent, left=None, right=None,
-                  axis=axis, sel_axis=sel_axis)
+                  axis=axis, sel_axis=sel_axis, dimensions=dimensions)
     root.left = create(point_list[:median],
                        dimensions, sel_axis(axis), parent=root)
     root.right = create(point_list[median + 1:],
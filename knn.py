@@ -6,10 +6,39 @@ Created on Wed Oct 07 23:45:21 2015
 """
 
 import kdtree
+import lsh
 import dill
 import copy
-from pickle import dump
-from pickle import load
+import multiprocessing
+import operator
+from pointbuffer import PointBuffer
+
+
+def _squared(a, b):
+    """
+    Squared Euclidean distance, the default distance of the kdtree.
+    """
+    return sum((a.get(axis, 0.) - b.get(axis, 0.))**2
+               for axis in range(len(a)))
+
+
+def vote(labels, neighbor_labels):
+    """
+    Using majority voting rule to decide the class of a group of neighbors,
+    neighbor_labels are their labels and labels all possible labels.
+
+    Returns an ordered list of (label, probability) tuples,
+    key=probability.
+    """
+    n = len(neighbor_labels)
+    prb = {}
+    for label in labels:
+        prb[label] = 0.0
+    for label in neighbor_labels:
+        prb[label] += 1
+    for label in labels:
+        prb[label] = prb[label] / n
+    return sorted(prb.items(), key=lambda n: n[1], reverse=True)
 
 
 class KNN:
@@ -19,7 +48,8 @@ class KNN:
     """
 
     def __init__(self, train_data=None, train_label=None, dimensions=None,
-                 axis=0, sel_axis=None):
+                 axis=0, sel_axis=None, storage=None, rerank=None,
+                 index='kdtree', index_params=None, projection=None):
         """
         Creates a new KNN model contains a kdtree build by the point_list.
 
@@ -37,15 +67,103 @@ class KNN:
         sel_axis is a function, sel_axis(axis) is used when creating subnodes
         of a node. It receives the axis of the parent node and returns the axis
         of the child node.
+
+        storage selects how the points are kept. By default (None) they are
+        kept as the given dicts. 'float32', 'int16' or 'int8' store every
+        point once in a compact PointBuffer, indexed by a kdtree.BufferTree
+        (an array of point indices), integer types are quantized per
+        dimension. train_data may also be a ready PointBuffer. A compact
+        storage only has the axes 0 .. dimensions - 1, points with 1-based
+        keys (which dict storage accepts) need dimensions one larger.
+
+        rerank is used with compact storage or a projection. If it is given,
+        classify() searches k * rerank candidates in the buffer (or the
+        reduced space) and re-ranks them by their distance in the original
+        space, computed in float64 from float32 coordinates, before voting.
+        int8/int16 storages keep a float32 copy of the points for this.
+
+        index is the search structure, 'kdtree' or 'lsh'. For high
+        dimensional data an lsh.LSHIndex avoids the near full scans of the
+        kdtree, index_params is a dict of its parameters (metric, tables,
+        width, bucket_width, probes, max_probes, seed), the bucket width is
+        fitted on train_data unless it is given.
+
+        projection is a projection.Projection, e.g. a GaussianProjection,
+        SparseProjection or PCAProjection. If it is given, the points are
+        projected to its components and the index is built and searched in
+        that reduced space. The projection is fitted on train_data unless it
+        already is, and is kept (and pickled) with the model.
         """
-        # As train_data is a list of samples, we use dict() to change data
-        # structure of samples.
-        self.train_data = train_data
-        self.train_label = train_label
+        self.train_label = list(train_label)
         self.labels = set(self.train_label)
         self.class_prb = self._calc_train_class_prb(self.train_label)
-        self.kdtree = kdtree.create(
-            copy.deepcopy(train_data), dimensions, axis, sel_axis)
+        self.rerank = rerank
+
+        if isinstance(train_data, PointBuffer):
+            # a spilling buffer can only be read once it is frozen
+            train_data.freeze()
+            storage = train_data.dtype
+        elif storage is not None:
+            buf = PointBuffer(dimensions, storage, exact=bool(rerank))
+            buf.fit(train_data)
+            buf.extend(train_data)
+            train_data = buf
+        self.storage = storage
+
+        if storage is None:
+            # As train_data is a list of samples, we use dict() to change data
+            # structure of samples.
+            self.train_data = list(train_data)
+        else:
+            # Points are kept only once, in the buffer.
+            self.train_data = train_data
+            dimensions = dimensions or train_data.dimensions
+        self.dimensions = dimensions
+        self.projection = projection
+        self.reduced = None
+        if projection is not None:
+            if projection.rows is None:
+                projection.fit(self.train_data, dimensions)
+            # the index is built on the projected points
+            self.reduced = PointBuffer(projection.components,
+                                       'float64' if storage is None
+                                       else 'float32')
+            for point in self.train_data:
+                self.reduced.append_values(projection.transform(point))
+            dimensions = projection.components
+        self.axis = axis
+        self.sel_axis = sel_axis
+        # aioknn.MicroBatcher used by aclassify(), created on first use
+        self.batcher = None
+
+        self.index = index
+        self.index_params = index_params
+        self.kdtree = None
+        self.lsh = None
+        if self.reduced is not None:
+            points = self.reduced
+        else:
+            points = self.train_data
+        if index == 'kdtree' and isinstance(points, PointBuffer):
+            # an array of indices over the buffer, no object per point
+            self.kdtree = kdtree.BufferTree(points, axis, sel_axis)
+        elif index == 'kdtree':
+            points = copy.deepcopy(points)
+            positions = dict((id(p), i) for i, p in enumerate(points))
+            self.kdtree = kdtree.create(points, dimensions, axis, sel_axis)
+            # dict points do not know their position, the nodes keep it
+            for node in kdtree.level_order(self.kdtree):
+                if node.data is not None:
+                    node.index = positions[id(node.data)]
+        elif index == 'lsh':
+            points = list(points)
+            self.lsh = lsh.LSHIndex(dimensions, **(index_params or {}))
+            self.lsh.fit(points)
+            for i, point in enumerate(points):
+                self.lsh.add(point, i)
+        else:
+            raise ValueError("index must be 'kdtree' or 'lsh', not %r" %
+                             (index,))
 
     def _calc_train_class_prb(self, labels_list=None):
         """
@@ -64,6 +182,53 @@ class KNN:
             prb[l] = (labels_list.count(l) + 1.0) / (n + label_num)
         return prb
 
+    def _sample_index(self, node):
+        """
+        Returns the position of the point of node in the training data.
+        """
+        return node.index
+
+    def _point(self, index):
+        """
+        Returns the training point at index in the original space, as a dict
+        of floats if the storage is compact.
+        """
+        if self.storage is None:
+            return self.train_data[index]
+        return self.train_data.exact_point(index)
+
+    def _search(self, point, k, dist=None):
+        """
+        Searches the k nearest neighbors of point in the index of the model,
+        point is in the reduced space if the model has a projection.
+        """
+        if self.lsh is not None:
+            return self.lsh.search_knn(point, k, dist)
+        return self.kdtree.search_knn(point, k, dist)
+
+    def _rerank(self, point, neighbors, k, dist=None):
+        """
+        Re-ranks neighbors found in the compact buffer or the reduced space
+        by their exact distance, keeps the k nearest (more in case of equal
+        distance).
+        """
+        if dist is None and self.lsh is not None:
+            # the metric the lsh index was searched with
+            dist = self.lsh.dist
+        elif dist is None:
+            dist = _squared
+
+        exact = []
+        for node, d in neighbors:
+            p = self._point(self._sample_index(node))
+            exact.append((node, dist(p, point)))
+        exact.sort(key=lambda n: n[1])
+
+        if len(exact) <= k:
+            return exact
+        kth = exact[k - 1][1]
+        return [(node, d) for node, d in exact if d <= kth]
+
     def decision(self, neighbors=None):
         """
         Using majority voting rule to decided class_label of group neighbors.
@@ -78,16 +243,24 @@ class KNN:
                           reverse=True)
 
         else:
-            n = len(neighbors)
-            prb = {}
-            for label in self.labels:
-                prb[label] = 0.0
-            for kdnode, dist in neighbors:
-                index = self.train_data.index(kdnode.data)
-                prb[self.train_label[index]] += 1
-            for label in self.labels:
-                prb[label] = prb[label] / n
-            return sorted(prb.items(), key=lambda n: n[1], reverse=True)
+            neighbor_labels = [self.train_label[self._sample_index(node)]
+                               for node, dist in neighbors]
+            return vote(self.labels, neighbor_labels)
+
+    def search_knn(self, point, k, dist=None):
+        """
+        Returns the k nearest neighbors of point in the model as an ordered
+        list of (node, distance) tuples, re-ranked by the exact distance if
+        the model has a compact storage or a projection and rerank set.
+        """
+        query = point
+        if self.projection is not None:
+            query = dict(enumerate(self.projection.transform(point)))
+        if self.rerank and (self.storage is not None or
+                            self.projection is not None):
+            neighbors = self._search(query, k * self.rerank, dist)
+            return self._rerank(point, neighbors, k, dist)
+        return self._search(query, k, dist)
 
     def classify(self, point=None, k=1, dist=None, prbout=0):
         """
@@ -117,7 +290,7 @@ class KNN:
         if not point:
             return []
 
-        neighbors = self.kdtree.search_knn(point, k, dist)
+        neighbors = self.search_knn(point, k, dist)
         prb = self.decision(neighbors)
         # print prb
         if prbout == 0:
@@ -125,22 +298,209 @@ class KNN:
         elif prbout == 1:
             return prb
 
+    def classify_batch(self, points, k=1, dist=None, prbout=0):
+        """
+        Classifies a list of points, see classify().
+        """
+        return [self.classify(point, k, dist, prbout) for point in points]
+
+    def aclassify(self, point=None, k=1, dist=None, prbout=0):
+        """
+        Asynchronous classify(), to be awaited in a running event loop.
+
+        Concurrent requests are collected into micro-batches by
+        self.batcher, and run on a pool of one process per CPU, unless
+        another aioknn.MicroBatcher is set. Every process holds a copy of the
+        model, call close() to free them when the model is not served any
+        more. add() closes the batcher, the next request starts a new pool
+        with the updated model.
+        """
+        if self.batcher is None:
+            import aioknn
+            self.batcher = aioknn.MicroBatcher(
+                self, processes=multiprocessing.cpu_count())
+        return self.batcher.classify(point, k, dist, prbout)
+
+    def close(self):
+        """
+        Closes the batcher of aclassify() and its worker processes, if there
+        is one.
+        """
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+    def __getstate__(self):
+        # the batcher is bound to an event loop and its executor
+        state = self.__dict__.copy()
+        state['batcher'] = None
+        return state
+
+    def add(self, point, label):
+        """
+        Adds a new sample to the model without rebuilding its index.
+
+        With an int8/int16 storage the point is quantized with the scale of
+        the training data, values outside its range are clipped.
+
+        The batcher of aclassify() is closed, its worker processes hold a
+        copy of the model without the new sample.
+        """
+        self.close()
+        if self.storage is None:
+            self.train_data.append(point)
+            point = copy.deepcopy(point)
+        else:
+            point = self.train_data.append(point)
+        if self.projection is not None:
+            point = self.reduced.append_values(
+                self.projection.transform(point))
+        self.train_label.append(label)
+        self.labels.add(label)
+        self.class_prb = self._calc_train_class_prb(self.train_label)
+
+        if self.lsh is not None:
+            self.lsh.add(point, len(self.train_label) - 1)
+        else:
+            node = self.kdtree.add(point)
+            node.index = len(self.train_label) - 1
+
+    def subset(self, indices):
+        """
+        Returns a new KNN model built with the same settings from the
+        training samples at the given indices.
+        """
+        if self.storage is None:
+            data = [self.train_data[i] for i in indices]
+        else:
+            data = self.train_data.take(indices)
+        labels = [self.train_label[i] for i in indices]
+        return self.__class__(data, labels, self.dimensions, self.axis,
+                              self.sel_axis, self.storage, self.rerank,
+                              self.index, self.index_params, self.projection)
+
+    def _edit(self, k, dist=None):
+        """
+        Wilson editing, returns the indices of the samples that agree with
+        the majority of their k nearest neighbors (not counting themselves).
+        """
+        keep = []
+        for i, point in enumerate(self.train_data):
+            neighbors = [(node, d) for node, d in
+                         self.search_knn(point, k + 1, dist)
+                         if self._sample_index(node) != i][:k]
+            if self.decision(neighbors)[0][0] == self.train_label[i]:
+                keep.append(i)
+        return keep
+
+    def _condense(self, indices, dist=None):
+        """
+        Hart's condensed nearest neighbor, returns a subset of indices that
+        still classifies all the samples at indices correctly with 1-NN.
+
+        The store starts with the first sample of every class, misclassified
+        samples are added to it until a whole pass adds nothing. The store is
+        scanned with the exact distance in the original space, so the result
+        holds whatever index, storage or projection the model uses.
+        """
+        dist = dist or _squared
+        # (point, label) of the samples kept
+        store = []
+        kept = set()
+        seen = set()
+        for i in indices:
+            if self.train_label[i] not in seen:
+                seen.add(self.train_label[i])
+                store.append((self._point(i), self.train_label[i]))
+                kept.add(i)
+
+        changed = True
+        while changed:
+            changed = False
+            for i in indices:
+                if i in kept:
+                    continue
+                point, label = self._point(i), self.train_label[i]
+                nearest = min(store, key=lambda s: dist(s[0], point))
+                if nearest[1] != label:
+                    store.append((point, label))
+                    kept.add(i)
+                    changed = True
+        return sorted(kept)
+
+    def reduce(self, method='cnn', k=3, dist=None, test_data=None,
+               test_label=None):
+        """
+        Prototype reduction, drops redundant training samples.
+
+        method is 'enn' (Wilson editing: removes the samples misclassified by
+        their k nearest neighbors, i.e. noise and overlapping borders), 'cnn'
+        (Hart's condensed nearest neighbor: keeps only the samples needed to
+        classify the rest correctly with 1-NN, mostly border points) or
+        'enn+cnn', editing first and then condensing.
+
+        Returns a (model, report) tuple, model is a new KNN built from the
+        retained samples. report is a dict with the number of original and
+        retained samples, the retained fraction, the accuracy of both models
+        on test_data (the training data if it is not given) and the fraction
+        of those points both models classify the same. The original model is
+        evaluated with k neighbors, the new one with k_after neighbors, 1 if
+        it was condensed, as that is the rule CNN keeps samples for.
+        """
+        if method not in ('enn', 'cnn', 'enn+cnn'):
+            raise ValueError("method must be 'enn', 'cnn' or 'enn+cnn', not "
+                             "%r" % (method,))
+
+        indices = list(range(len(self.train_label)))
+        if method in ('enn', 'enn+cnn'):
+            indices = self._edit(k, dist)
+        if method in ('cnn', 'enn+cnn'):
+            indices = self._condense(indices, dist)
+        model = self.subset(indices)
+        k_after = 1 if method in ('cnn', 'enn+cnn') else k
+
+        if test_data is None:
+            test_data, test_label = self.train_data, self.train_label
+        before = [self.classify(p, k, dist) for p in test_data]
+        after = [model.classify(p, k_after, dist) for p in test_data]
+        n = len(test_label)
+        report = {
+            'method': method,
+            'k_before': k,
+            'k_after': k_after,
+            'original': len(self.train_label),
+            'retained': len(indices),
+            'retained_fraction':
+                float(len(indices)) / max(1, len(self.train_label)),
+            'accuracy_before':
+                float(sum(map(operator.eq, before, test_label))) / max(1, n),
+            'accuracy_after':
+                float(sum(map(operator.eq, after, test_label))) / max(1, n),
+            'agreement':
+                float(sum(map(operator.eq, before, after))) / max(1, n),
+        }
+        return model, report
+
     def visualize_kdtree(self):
         """
         Visualize the kdtree.
         """
-        kdtree.visualize(self.kdtree)
+        tree = self.kdtree
+        if isinstance(tree, kdtree.BufferTree):
+            tree = tree.nodes()
+        kdtree.visualize(tree)
 
 
 def saveknn(knn_model, outfile):
-    out = open(outfile, 'w')
-    # Pickle the knn_model using the highest protocol available.
-    dump(knn_model, out, -1)
+    out = open(outfile, 'wb')
+    # Pickle the knn_model using the highest protocol available, with dill
+    # as the default sel_axis (and maybe dist or a source) is a lambda.
+    dill.dump(knn_model, out, -1)
     out.close()
 
 
 def loadknn(srcfile):
-    src = open(srcfile, 'r')
-    knn_model = load(src)
+    src = open(srcfile, 'rb')
+    knn_model = dill.load(src)
     src.close()
     return knn_model
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Locality-sensitive hashing index.
+
+For high dimensional data the kd-tree has to visit nearly every node, an
+LSHIndex instead only looks at the points that share a hash bucket with the
+query point in one of its tables.
+
+    cosine: random hyperplanes, every hash function is one sign bit.
+    p = 1:  Cauchy (1-stable) projections, h(v) = floor(a.v / r + b).
+    p = 2:  Gaussian (2-stable) projections, same form.
+
+The candidates are re-ranked with the exact metric, so the results come in
+the same (node, distance) form as KDNode.search_knn().
+"""
+
+import heapq
+import math
+import random
+
+import Distance as ds
+
+
+def CosineDistance(a, b):
+    """
+    Cosine distance, 1 - cos(a, b). Zero vectors are at distance 1.
+    """
+    dot = sum(a.get(axis, 0.) * b.get(axis, 0.) for axis in range(len(a)))
+    na = math.sqrt(sum(a.get(axis, 0.)**2 for axis in range(len(a))))
+    nb = math.sqrt(sum(v**2 for v in b.values()))
+    if not na or not nb:
+        return 1.0
+    return 1.0 - dot / (na * nb)
+
+
+class LSHNode(object):
+    """
+    A point stored in an LSHIndex.
+
+    index is the id the point was added with.
+    """
+
+    __slots__ = ('data', 'index')
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    def __repr__(self):
+        return "<%(cls)s - %(data)s>" % dict(cls=self.__class__.__name__,
+                                             data=repr(self.data))
+
+
+class LSHIndex(object):
+    """
+    A set of hash tables over points of the same dimensionality.
+    """
+
+    def __init__(self, dimensions, metric='cosine', tables=8, width=8,
+                 bucket_width=None, probes=0, max_probes=64, seed=None):
+        """
+        Creates an empty index.
+
+        metric is 'cosine', or p of the Minkowski distance, 1 or 2.
+
+        tables is the number of hash tables, width the number of hash
+        functions concatenated into the key of one table. More tables give a
+        better recall, a larger width gives smaller buckets.
+
+        bucket_width is r of the p-stable hash functions, it is not used for
+        cosine. If it is None it is fitted on the data by fit(), which must
+        be called before adding points.
+
+        probes is the default number of extra buckets looked up in every
+        table (multi-probe LSH), can be overridden per query. A query that
+        finds fewer candidates than the neighbors asked for doubles its
+        probes, up to max_probes, and then scans all the points.
+
+        seed seeds the random projections.
+        """
+        if metric not in ('cosine', 1, 2):
+            raise ValueError("metric must be 'cosine', 1 or 2, not %r" %
+                             (metric,))
+
+        self.dimensions = dimensions
+        self.metric = metric
+        self.width = width
+        self.bucket_width = bucket_width
+        self.probes = probes
+        self.max_probes = max_probes
+        self.seed = seed
+        if metric == 'cosine':
+            self.dist = CosineDistance
+        else:
+            self.dist = ds.MinkowskiDistance(metric)
+
+        rnd = random.Random(seed)
+        if metric == 1:
+            # standard Cauchy distribution
+            sample = lambda: math.tan(math.pi * (rnd.random() - 0.5))
+        else:
+            sample = lambda: rnd.gauss(0., 1.)
+
+        # every table has width (vector, offset) hash functions
+        self.functions = []
+        for t in range(tables):
+            table = []
+            for w in range(width):
+                a = [sample() for axis in range(dimensions)]
+                # offset as a fraction of the bucket width
+                b = rnd.random()
+                table.append((a, b))
+            self.functions.append(table)
+
+        self.tables = [{} for t in range(tables)]
+        self.points = {}
+
+    def fit(self, point_list, sample=200):
+        """
+        Fits bucket_width to the scale of the data, if it was not given.
+
+        It is set to twice the median distance of a random sample of the
+        points to their nearest neighbor within the sample, so a query
+        usually shares its buckets with the points at that distance or
+        nearer.
+        """
+        if self.metric == 'cosine' or self.bucket_width is not None:
+            return
+        points = list(point_list)
+        rnd = random.Random(self.seed)
+        if len(points) > sample:
+            points = rnd.sample(points, sample)
+
+        nearest = []
+        for i, p in enumerate(points):
+            d = [self.dist(p, q) for j, q in enumerate(points) if j != i]
+            if d:
+                nearest.append(min(d))
+        nearest = sorted(d for d in nearest if d > 0)
+        if nearest:
+            self.bucket_width = 2.0 * nearest[len(nearest) // 2]
+        else:
+            self.bucket_width = 1.0
+
+    def _project(self, point, table):
+        """
+        Returns the raw hash values of point for one table.
+
+        For cosine these are the signed distances to the hyperplanes, for
+        p-stable hashes they are a.v / r + b, the key being their floor.
+        """
+        values = [point.get(axis, 0.) for axis in range(self.dimensions)]
+        raw = []
+        for a, b in self.functions[table]:
+            dot = sum(x * y for x, y in zip(a, values))
+            if self.metric == 'cosine':
+                raw.append(dot)
+            else:
+                raw.append(dot / self.bucket_width + b)
+        return raw
+
+    def _key(self, raw):
+        if self.metric == 'cosine':
+            return tuple(int(v >= 0) for v in raw)
+        return tuple(int(math.floor(v)) for v in raw)
+
+    def _perturbations(self, raw):
+        """
+        Returns the (cost, component, delta) steps that move the key of raw
+        to a neighbouring bucket, cheapest first.
+
+        The cost is the squared distance of the projection to the boundary
+        it would cross.
+        """
+        steps = []
+        for i, v in enumerate(raw):
+            if self.metric == 'cosine':
+                steps.append((v * v, i, None))
+            else:
+                frac = v - math.floor(v)
+                steps.append((frac * frac, i, -1))
+                steps.append(((1. - frac)**2, i, 1))
+        steps.sort()
+        return steps
+
+    def _probe_keys(self, raw, probes):
+        """
+        Yields the key of raw followed by up to probes perturbed keys,
+        in order of increasing perturbation cost.
+
+        Perturbation sets are generated with the shift/expand heap of
+        multi-probe LSH (Lv et al., 2007).
+        """
+        key = self._key(raw)
+        yield key
+        if not probes:
+            return
+
+        steps = self._perturbations(raw)
+        heap = [(steps[0][0], (0,))]
+        found = 0
+        while heap and found < probes:
+            cost, chosen = heapq.heappop(heap)
+            last = chosen[-1]
+            if last + 1 < len(steps):
+                shifted = chosen[:-1] + (last + 1,)
+                expanded = chosen + (last + 1,)
+                heapq.heappush(heap, (cost - steps[last][0] +
+                                      steps[last + 1][0], shifted))
+                heapq.heappush(heap, (cost + steps[last + 1][0], expanded))
+
+            components = [steps[j][1] for j in chosen]
+            if len(set(components)) < len(components):
+                # moves the same component twice
+                continue
+
+            probe = list(key)
+            for j in chosen:
+                c, i, delta = steps[j]
+                if delta is None:
+                    probe[i] = 1 - probe[i]
+                else:
+                    probe[i] += delta
+            found += 1
+            yield tuple(probe)
+
+    def add(self, point, index=None):
+        """
+        Adds a point to the index and returns its LSHNode.
+
+        index is the id reported for the point by search_knn(), by default
+        the number of points added before it.
+        """
+        if self.metric != 'cosine' and self.bucket_width is None:
+            raise ValueError('bucket_width is not set, call fit() before '
+                             'adding points')
+        if index is None:
+            index = len(self.points)
+        node = LSHNode(point, index)
+        self.points[index] = node
+        for t, table in enumerate(self.tables):
+            key = self._key(self._project(point, t))
+            table.setdefault(key, []).append(index)
+        return node
+
+    def candidates(self, point, probes=None):
+        """
+        Returns the set of ids found in the buckets of point.
+        """
+        if probes is None:
+            probes = self.probes
+        found = set()
+        for t, table in enumerate(self.tables):
+            for key in self._probe_keys(self._project(point, t), probes):
+                found.update(table.get(key, ()))
+        return found
+
+    def search_knn(self, point, k, dist=None, probes=None):
+        """
+        Returns the k nearest neighbors of the given point and their distance
+        among the candidates found in its buckets.
+
+        k is the number of results to return. The actual results can be less
+        (if there aren't enough candidates) or more in case of equal
+        distance.
+
+        dist is a distance function, expecting two points and returning a
+        distance value, used to re-rank the candidates. By default it is the
+        metric of the index.
+
+        probes is the number of extra buckets looked up per table, by default
+        self.probes. It is raised when there are fewer than k candidates.
+
+        The result is an ordered list of (node, distance) tuples.
+        """
+        dist = dist or self.dist
+        if probes is None:
+            probes = self.probes
+        found = self.candidates(point, probes)
+        while len(found) < k and probes < self.max_probes:
+            probes = min(self.max_probes, max(1, 2 * probes))
+            found = self.candidates(point, probes)
+        if len(found) < k:
+            # too few neighbors in the buckets, scan all the points
+            found = self.points
+
+        results = []
+        for index in found:
+            node = self.points[index]
+            results.append((node, dist(node.data, point)))
+        results.sort(key=lambda n: n[1])
+
+        if len(results) <= k:
+            return results
+        kth = results[k - 1][1]
+        return [(node, d) for node, d in results if d <= kth]
+
+    def __len__(self):
+        return len(self.points)
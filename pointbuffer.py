@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact storage of training points.
+
+A PointBuffer keeps the coordinates of all points in one contiguous
+array.array, either as float32 or quantized to int8/int16 with a per-dimension
+scale and offset. Points are handed out as BufferPoint views, which behave
+like the dict points used everywhere else (point.get(axis, 0.)) but do not
+hold any coordinates themselves.
+"""
+
+import mmap
+from array import array
+
+# maps dtype name to (array typecode, quantization range)
+# a range of None means the values are stored as they are
+DTYPES = {
+    'float64': ('d', None),
+    'float32': ('f', None),
+    'int16': ('h', 32767),
+    'int8': ('b', 127),
+}
+
+
+class BufferPoint(object):
+    """
+    A read-only view of one point stored in a PointBuffer.
+
+    index is the position of the point in the buffer, which is also the
+    position of its label in the training labels.
+    """
+
+    __slots__ = ('buffer', 'index')
+
+    def __init__(self, buffer, index):
+        self.buffer = buffer
+        self.index = index
+
+    def get(self, axis, default=0.):
+        if 0 <= axis < self.buffer.dimensions:
+            return self.buffer.value(self.index, axis)
+        return default
+
+    def __getitem__(self, axis):
+        if 0 <= axis < self.buffer.dimensions:
+            return self.buffer.value(self.index, axis)
+        raise KeyError(axis)
+
+    def __len__(self):
+        return self.buffer.dimensions
+
+    def __iter__(self):
+        return iter(range(self.buffer.dimensions))
+
+    def keys(self):
+        return list(range(self.buffer.dimensions))
+
+    def values(self):
+        return [self.buffer.value(self.index, axis)
+                for axis in range(self.buffer.dimensions)]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def to_dict(self):
+        """
+        Returns the point as a plain dict of floats.
+        """
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, BufferPoint):
+            return other.buffer is self.buffer and other.index == self.index
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.buffer), self.index))
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class PointBuffer(object):
+    """
+    A contiguous buffer of points of the same dimensionality.
+    """
+
+    def __init__(self, dimensions, dtype='float32', scale=None, offset=None,
+                 exact=False, spill=None, memory_limit=1 << 20):
+        """
+        Creates an empty buffer for points of the given dimensions.
+
+        Axes of the stored points are 0 .. dimensions - 1, values on other
+        axes are rejected.
+
+        dtype is one of 'float64', 'float32', 'int16' or 'int8'. Integer
+        dtypes quantize each dimension as round((value - offset) / scale);
+        scale and offset are lists with one entry per dimension, if they are
+        not given they must be computed by fit() before adding points.
+        Values outside the fitted range are clipped.
+
+        If exact is True, integer dtypes keep a float32 copy of every point
+        as well, so exact_point() returns the coordinates before quantization.
+        This is what re-ranking uses, at 4 more bytes per coordinate, unless
+        the buffer spills. Float dtypes never keep a copy, their values are
+        already as precise as it would be.
+
+        spill is the path of a file for buffers larger than memory. Once more
+        than memory_limit values are held in memory they are appended to the
+        file (the exact copy goes to spill + '.exact'). After the last point
+        is added freeze() memory-maps the file(s), once values were written
+        to the file the points can only be read (or the buffer pickled)
+        after that. Points added later are appended to the file(s), which
+        are mapped again. Spilling needs Python 3.
+        """
+        if dtype not in DTYPES:
+            raise ValueError('unknown dtype %r, expected one of %s' %
+                             (dtype, ', '.join(sorted(DTYPES))))
+
+        self.dimensions = dimensions
+        self.dtype = dtype
+        self.typecode, self.qmax = DTYPES[dtype]
+        self.scale = scale
+        self.offset = offset
+        # float values are their own exact copy
+        self.exact = bool(exact) and self.qmax is not None
+        self.spill = spill
+        self.memory_limit = memory_limit
+        self.frozen = False
+        self.count = 0
+        self._values = array(self.typecode)
+        self._exact = array('f') if self.exact else None
+        self._files = None
+
+    def fit(self, point_list):
+        """
+        Computes the per-dimension scale and offset of integer dtypes from
+        the range of the given points. Does nothing for float dtypes.
+        """
+        self.fit_values([point.get(axis, 0.) for axis in
+                         range(self.dimensions)] for point in point_list)
+
+    def fit_values(self, rows):
+        """
+        Same as fit(), for rows that are sequences of the values of all
+        dimensions.
+        """
+        if self.qmax is None:
+            return
+
+        low = [float('inf')] * self.dimensions
+        high = [float('-inf')] * self.dimensions
+        for values in rows:
+            for axis, v in enumerate(values):
+                if v < low[axis]:
+                    low[axis] = v
+                if v > high[axis]:
+                    high[axis] = v
+
+        self.offset = []
+        self.scale = []
+        for lo, hi in zip(low, high):
+            if lo > hi:
+                # no points at all
+                lo = hi = 0.
+            self.offset.append((hi + lo) / 2.0)
+            self.scale.append(((hi - lo) / (2.0 * self.qmax)) or 1.0)
+
+    def _encode(self, axis, v):
+        if self.qmax is None:
+            return v
+        q = int(round((v - self.offset[axis]) / self.scale[axis]))
+        return max(-self.qmax, min(self.qmax, q))
+
+    def append(self, point):
+        """
+        Adds a point to the end of the buffer and returns its view.
+        """
+        for axis in point.keys():
+            if not 0 <= axis < self.dimensions:
+                raise ValueError('axis %r is out of range for a buffer of %d '
+                                 'dimensions, axes are 0 .. %d (use '
+                                 'dimensions=%d for 1-based points)' %
+                                 (axis, self.dimensions, self.dimensions - 1,
+                                  self.dimensions + 1))
+        return self.append_values([point.get(axis, 0.)
+                                   for axis in range(self.dimensions)])
+
+    def append_values(self, values):
+        """
+        Adds a point given as the sequence of its values on all dimensions,
+        returns its view.
+        """
+        if self.qmax is not None and self.scale is None:
+            raise ValueError('%s buffers need a scale and offset, call fit() '
+                             'before adding points' % self.dtype)
+        if len(values) != self.dimensions:
+            raise ValueError('expected %d values, got %d' %
+                             (self.dimensions, len(values)))
+
+        encoded = array(self.typecode, [self._encode(axis, v)
+                                        for axis, v in enumerate(values)])
+        if self.frozen:
+            # append to the file(s) and map them again
+            with open(self.spill, 'ab') as f:
+                encoded.tofile(f)
+            if self.exact:
+                with open(self.spill + '.exact', 'ab') as f:
+                    array('f', values).tofile(f)
+            self.count += 1
+            self._map()
+            return BufferPoint(self, self.count - 1)
+
+        self._values.extend(encoded)
+        if self._exact is not None:
+            self._exact.extend(values)
+        self.count += 1
+
+        if self.spill is not None and len(self._values) >= self.memory_limit:
+            self._flush()
+        return BufferPoint(self, self.count - 1)
+
+    def _flush(self):
+        """
+        Appends the values held in memory to the spill file(s).
+        """
+        if self._files is None:
+            self._files = [open(self.spill, 'wb')]
+            if self.exact:
+                self._files.append(open(self.spill + '.exact', 'wb'))
+        self._values.tofile(self._files[0])
+        self._values = array(self.typecode)
+        if self.exact:
+            self._exact.tofile(self._files[1])
+            self._exact = array('f')
+
+    def _load(self, path, typecode):
+        with open(path, 'rb') as f:
+            if not f.seek(0, 2):
+                return array(typecode)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mm).cast(typecode)
+
+    def freeze(self):
+        """
+        Writes the rest of a spilling buffer to its file(s) and memory-maps
+        them. Does nothing for buffers without spill.
+        """
+        if self.spill is None or self.frozen:
+            return
+        self._flush()
+        for f in self._files:
+            f.close()
+        self._files = None
+        self.frozen = True
+        self._map()
+
+    def _map(self):
+        self._values = self._load(self.spill, self.typecode)
+        if self.exact:
+            self._exact = self._load(self.spill + '.exact', 'f')
+
+    def extend(self, point_list):
+        """
+        Adds all points of point_list to the buffer.
+        """
+        for point in point_list:
+            self.append(point)
+
+    def take(self, indices):
+        """
+        Returns a new buffer with the points at the given indices, in that
+        order. The stored values are copied as they are, with the same dtype,
+        scale and offset.
+        """
+        self._check_readable()
+        buf = self.__class__(self.dimensions, self.dtype, self.scale,
+                             self.offset, exact=self.exact)
+        dims = self.dimensions
+        for index in indices:
+            start = index * dims
+            buf._values.extend(self._values[start:start + dims])
+            if self._exact is not None:
+                buf._exact.extend(self._exact[start:start + dims])
+            buf.count += 1
+        return buf
+
+    def _check_readable(self):
+        if self._files is not None:
+            raise ValueError('the buffer has spilled to %r, call freeze() '
+                             'before reading its points' % (self.spill,))
+
+    def value(self, index, axis):
+        """
+        Returns the stored (dequantized) value of a point at the given axis.
+        """
+        if self._files is not None:
+            self._check_readable()
+        v = self._values[index * self.dimensions + axis]
+        if self.qmax is None:
+            return v
+        return v * self.scale[axis] + self.offset[axis]
+
+    def exact_point(self, index):
+        """
+        Returns the point at index as a dict of floats.
+
+        Uses the float32 copy when the buffer keeps one, otherwise the stored
+        values are dequantized.
+        """
+        if self._exact is None:
+            return self[index].to_dict()
+        self._check_readable()
+        start = index * self.dimensions
+        return dict(enumerate(self._exact[start:start + self.dimensions]))
+
+    def nbytes(self):
+        """
+        Returns the number of bytes used by the coordinate arrays.
+        """
+        n = len(self._values) * self._values.itemsize
+        if self._exact is not None:
+            n += len(self._exact) * self._exact.itemsize
+        return n
+
+    def __getstate__(self):
+        if self._files is not None:
+            raise ValueError('the buffer has spilled to %r, call freeze() '
+                             'before pickling it' % (self.spill,))
+        state = self.__dict__.copy()
+        if self.frozen:
+            # a frozen buffer is pickled by the path of its file(s)
+            state['_values'] = state['_exact'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.frozen:
+            self._map()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('point index out of range')
+        return BufferPoint(self, index)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield BufferPoint(self, index)
+
+    def __repr__(self):
+        return "<%(cls)s - %(n)d points, %(dims)d dimensions, %(dtype)s>" % \
+            dict(cls=self.__class__.__name__, n=self.count,
+                 dims=self.dimensions, dtype=self.dtype)
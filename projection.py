@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dimensionality reduction of points before indexing.
+
+kd-tree pruning does not work in hundreds of dimensions, a projection maps
+the points to a few components first:
+
+    GaussianProjection: dense random Gaussian matrix.
+    SparseProjection:   sparse random matrix (Achlioptas / Li), most
+                        weights are 0.
+    PCAProjection:      the principal components of the training data.
+
+The random projections approximately preserve Euclidean distances
+(Johnson-Lindenstrauss), PCA keeps the directions of largest variance.
+"""
+
+import math
+import random
+
+
+class Projection(object):
+    """
+    A linear map from points of dimensions values to components values.
+
+    rows holds one list of (axis, weight) pairs per component, it is None
+    until the projection is fitted. The subclasses compute them in
+    fit(point_list, dimensions), point_list being the training data, which
+    returns the projection.
+    """
+
+    def __init__(self, components, seed=None):
+        self.components = components
+        self.seed = seed
+        self.dimensions = None
+        self.rows = None
+
+    def transform(self, point):
+        """
+        Returns the projected point as the list of its components.
+        """
+        values = [point.get(axis, 0.) for axis in range(self.dimensions)]
+        return [sum(w * values[axis] for axis, w in row) for row in self.rows]
+
+
+class GaussianProjection(Projection):
+    """
+    Random projection with N(0, 1 / components) weights.
+    """
+
+    def fit(self, point_list, dimensions):
+        rnd = random.Random(self.seed)
+        sigma = 1.0 / math.sqrt(self.components)
+        self.dimensions = dimensions
+        self.rows = [[(axis, rnd.gauss(0., sigma))
+                      for axis in range(dimensions)]
+                     for c in range(self.components)]
+        return self
+
+
+class SparseProjection(Projection):
+    """
+    Sparse random projection, a weight is +-sqrt(1 / (density * components))
+    with probability density / 2 each, and 0 otherwise.
+    """
+
+    def __init__(self, components, density=None, seed=None):
+        """
+        density defaults to 1 / sqrt(dimensions).
+        """
+        Projection.__init__(self, components, seed)
+        self.density = density
+
+    def fit(self, point_list, dimensions):
+        rnd = random.Random(self.seed)
+        density = self.density or 1.0 / math.sqrt(dimensions)
+        w = math.sqrt(1.0 / (density * self.components))
+        self.dimensions = dimensions
+        self.rows = []
+        for c in range(self.components):
+            row = []
+            for axis in range(dimensions):
+                u = rnd.random()
+                if u < density / 2:
+                    row.append((axis, -w))
+                elif u < density:
+                    row.append((axis, w))
+            self.rows.append(row)
+        return self
+
+
+class PCAProjection(Projection):
+    """
+    Projection on the principal components of the training data, found by
+    power iteration with deflation.
+    """
+
+    def __init__(self, components, iterations=30, sample=2000, seed=None):
+        """
+        iterations is the number of power iterations per component, sample
+        the largest number of training points (chosen at random) the
+        components are computed on.
+        """
+        Projection.__init__(self, components, seed)
+        self.iterations = iterations
+        self.sample = sample
+
+    def fit(self, point_list, dimensions):
+        rnd = random.Random(self.seed)
+        points = list(point_list)
+        if self.sample and len(points) > self.sample:
+            points = rnd.sample(points, self.sample)
+        data = [[p.get(axis, 0.) for axis in range(dimensions)]
+                for p in points]
+        n = float(len(data)) or 1.0
+        mean = [sum(column) / n for column in zip(*data)]
+        data = [[v - m for v, m in zip(row, mean)] for row in data]
+
+        found = []
+        for c in range(self.components):
+            v = [rnd.gauss(0., 1.) for axis in range(dimensions)]
+            for i in range(self.iterations):
+                # v = Cov * v, without computing the covariance matrix
+                w = [0.] * dimensions
+                for row in data:
+                    dot = sum(x * y for x, y in zip(row, v))
+                    for axis, x in enumerate(row):
+                        w[axis] += dot * x
+                # remove the components found before
+                for u in found:
+                    dot = sum(x * y for x, y in zip(w, u))
+                    w = [x - dot * y for x, y in zip(w, u)]
+                norm = math.sqrt(sum(x * x for x in w))
+                if not norm:
+                    break
+                v = [x / norm for x in w]
+            found.append(v)
+
+        self.dimensions = dimensions
+        self.rows = [list(enumerate(v)) for v in found]
+        return self
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A KNN model sharded across local worker processes.
+
+Every shard is a KNN model living in its own process, so the training data
+and the index are split between processes and built in parallel. Queries
+are sent to all shards, the neighbors they return are merged into the global
+k nearest before voting.
+
+A shard can load its own samples from a source, a function called in the
+shard's process that returns an iterable of (point, label) samples, e.g.
+
+    functools.partial(ingest.iter_csv, 'part-0.csv', label_type=int)
+
+so the parent never holds the training data.
+
+Messages between the processes are serialized with dill, so distance
+functions and sources can be lambdas, as the ones in Distance.py.
+"""
+
+import multiprocessing
+import threading
+import traceback
+
+import dill
+import ingest
+import knn
+from pointbuffer import PointBuffer
+
+
+def _build(train_data, train_label, source, params):
+    """
+    Returns the KNN model of a shard, built from the given samples or the
+    samples of source.
+    """
+    if source is None:
+        return knn.KNN(train_data, train_label, **params)
+
+    samples = source()
+    if params.get('storage') is not None:
+        # straight into the compact buffer
+        builder = ingest.Builder(params['dimensions'], params['storage'],
+                                 params.get('rerank'))
+        builder.feed(samples)
+        others = dict((k, v) for k, v in params.items()
+                      if k not in ('dimensions', 'storage', 'rerank'))
+        return builder.build(**others)
+
+    train_data, train_label = [], []
+    for point, label in samples:
+        if not hasattr(point, 'keys'):
+            point = dict(enumerate(point))
+        train_data.append(point)
+        train_label.append(label)
+    return knn.KNN(train_data, train_label, **params)
+
+
+def _worker(conn):
+    """
+    Main loop of a shard process, serves commands until 'close'.
+    """
+    model = None
+    while True:
+        try:
+            cmd, args = dill.loads(conn.recv_bytes())
+        except EOFError:
+            break
+        if cmd == 'close':
+            break
+
+        try:
+            if cmd == 'build':
+                model = _build(*args)
+                counts = {}
+                for label in model.train_label:
+                    counts[label] = counts.get(label, 0) + 1
+                reply = (counts, model.projection)
+            elif cmd == 'add':
+                point, label = args
+                model.add(point, label)
+                reply = None
+            elif cmd == 'search':
+                points, k, dist = args
+                reply = []
+                for point in points:
+                    neighbors = model.search_knn(point, k, dist)
+                    if not model.rerank and (model.storage is not None or
+                                             model.projection is not None):
+                        # distances of all shards must be in the same,
+                        # original space to be merged
+                        neighbors = model._rerank(point, neighbors, k, dist)
+                    reply.append([])
+                    for node, d in neighbors:
+                        i = model._sample_index(node)
+                        reply[-1].append((dict(model._point(i).items()), d,
+                                          model.train_label[i]))
+            else:
+                raise ValueError('unknown command %r' % (cmd,))
+            conn.send_bytes(dill.dumps(('ok', reply)))
+        except Exception:
+            conn.send_bytes(dill.dumps(('error', traceback.format_exc())))
+    conn.close()
+
+
+def merge(results, k):
+    """
+    Merges the (point, distance, label) lists of several shards into the
+    global k nearest, more in case of equal distance.
+    """
+    merged = sorted((r for result in results for r in result),
+                    key=lambda n: n[1])
+    if len(merged) <= k:
+        return merged
+    kth = merged[k - 1][1]
+    return [r for r in merged if r[1] <= kth]
+
+
+class ShardedKNN(object):
+    """
+    A KNN model whose samples are partitioned over worker processes.
+    """
+
+    def __init__(self, train_data=None, train_label=None, shards=2,
+                 sources=None, **params):
+        """
+        Creates shards KNN models from the training data, each in its own
+        process. The samples are assigned to the shards round-robin and the
+        shards are built in parallel. train_data may be a list of dict
+        points or a PointBuffer.
+
+        If sources is given, it is a list with the source of every shard
+        instead, and train_data, train_label and shards are not used. With a
+        compact storage the shards read their samples with an
+        ingest.Builder, dimensions must be given then.
+
+        params are the keyword arguments of every shard's KNN, e.g.
+        dimensions, storage, rerank, index and index_params. A projection
+        that is not fitted yet is fitted by the first shard, on its samples,
+        and then used by all shards, so they search the same reduced space.
+        """
+        self.params = params
+        # serializes the command/reply exchanges with the shards, e.g. of
+        # batches run on several executor threads
+        self._lock = threading.RLock()
+        # aioknn.MicroBatcher used by aclassify(), created on first use
+        self.batcher = None
+        self.shards = []
+        # maps label to its number of samples, for every shard
+        self.shard_counts = []
+        self.labels = set()
+        self.class_prb = {}
+
+        if sources is None:
+            sources = [None] * shards
+            train_data = train_data if train_data is not None else []
+            train_label = train_label or []
+        pending = []
+        for i, source in enumerate(sources):
+            if source is not None:
+                data, labels = None, None
+            elif isinstance(train_data, PointBuffer):
+                indices = range(i, len(train_data), shards)
+                data = train_data.take(indices)
+                labels = [train_label[j] for j in indices]
+            else:
+                data = train_data[i::shards]
+                labels = train_label[i::shards]
+            pending.append(self._start(data, labels, source))
+
+            projection = params.get('projection')
+            if i == 0 and projection is not None and projection.rows is None:
+                self._collect(pending)
+                pending = []
+        self._collect(pending)
+
+    def _collect(self, pending):
+        """
+        Waits for the builds of the pending shards, takes over the projection
+        fitted by the first one.
+        """
+        for shard, (counts, projection) in zip(pending,
+                                               self._replies(pending)):
+            self.shard_counts[shard] = counts
+            if projection is not None:
+                self.params['projection'] = projection
+        self._update_labels()
+
+    def _start(self, train_data, train_label, source=None):
+        """
+        Starts a new shard process and sends it its build command, without
+        waiting for the build to finish. Returns the shard number.
+        """
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_worker, args=(child,))
+        process.daemon = True
+        process.start()
+        child.close()
+        self.shards.append((process, parent))
+        self.shard_counts.append({})
+        self._send(len(self.shards) - 1, 'build',
+                   (train_data, train_label, source, self.params))
+        return len(self.shards) - 1
+
+    def _send(self, shard, cmd, args=None):
+        self.shards[shard][1].send_bytes(dill.dumps((cmd, args)))
+
+    def _reply(self, shard):
+        return self._replies([shard])[0]
+
+    def _replies(self, shards):
+        """
+        Reads the replies of all the given shards, so none is left in its
+        pipe, then raises the first error if there was one.
+        """
+        replies = [dill.loads(self.shards[shard][1].recv_bytes())
+                   for shard in shards]
+        for shard, (status, reply) in zip(shards, replies):
+            if status == 'error':
+                raise RuntimeError('shard %d failed:\n%s' % (shard, reply))
+        return [reply for status, reply in replies]
+
+    def _update_labels(self):
+        """
+        Recalculates the labels and their probabilities over all shards,
+        using Laplace Smoothing as KNN does.
+        """
+        counts = {}
+        for shard_counts in self.shard_counts:
+            for label, c in shard_counts.items():
+                counts[label] = counts.get(label, 0) + c
+        self.labels = set(counts)
+        n = sum(counts.values())
+        self.class_prb = dict(
+            (l, (c + 1.0) / (n + len(counts))) for l, c in counts.items())
+
+    def add_shard(self, train_data=None, train_label=None, source=None):
+        """
+        Adds a new shard built from the given samples or source, returns its
+        number.
+        """
+        with self._lock:
+            shard = self._start(train_data, train_label, source)
+            self._collect([shard])
+        return shard
+
+    def rebuild_shard(self, shard, train_data=None, train_label=None,
+                      source=None):
+        """
+        Replaces the samples of a shard with the given samples or source and
+        rebuilds its index. The other shards are not touched.
+        """
+        with self._lock:
+            self._send(shard, 'build',
+                       (train_data, train_label, source, self.params))
+            self._collect([shard])
+
+    def add(self, point, label, shard=None):
+        """
+        Adds a sample to a shard, by default the smallest one.
+        """
+        with self._lock:
+            if shard is None:
+                sizes = [sum(c.values()) for c in self.shard_counts]
+                shard = sizes.index(min(sizes))
+            self._send(shard, 'add', (point, label))
+            self._reply(shard)
+            counts = self.shard_counts[shard]
+            counts[label] = counts.get(label, 0) + 1
+            self._update_labels()
+
+    def search_batch(self, points, k, dist=None):
+        """
+        Returns the k nearest neighbors of every point as ordered lists of
+        (point, distance, label) tuples.
+
+        The whole batch is sent to all shards at once, which search it in
+        parallel, the per-shard results are merged by distance.
+        """
+        with self._lock:
+            for shard in range(len(self.shards)):
+                self._send(shard, 'search', (points, k, dist))
+            replies = self._replies(range(len(self.shards)))
+        return [merge(results, k) for results in zip(*replies)]
+
+    def search_knn(self, point, k, dist=None):
+        """
+        Returns the k nearest neighbors of point over all shards, as an
+        ordered list of (point, distance, label) tuples.
+        """
+        return self.search_batch([point], k, dist)[0]
+
+    def decision(self, neighbors=None):
+        """
+        Using majority voting rule to decided class_label of group neighbors,
+        a list of (point, distance, label) tuples.
+
+        When neighbors is None, returns self.class_prb.
+        """
+        if not neighbors:
+            return sorted(self.class_prb.items(), key=lambda n: n[1],
+                          reverse=True)
+        return knn.vote(self.labels, [label for p, d, label in neighbors])
+
+    def classify_batch(self, points, k=1, dist=None, prbout=0):
+        """
+        Classifies a list of points, see KNN.classify(). Every shard is
+        queried once for the whole batch.
+        """
+        results = self.search_batch(points, k, dist)
+        out = []
+        for neighbors in results:
+            prb = self.decision(neighbors)
+            out.append(prb[0][0] if prbout == 0 else prb)
+        return out
+
+    def classify(self, point=None, k=1, dist=None, prbout=0):
+        """
+        Classify the point, see KNN.classify().
+        """
+        if not point:
+            return []
+        return self.classify_batch([point], k, dist, prbout)[0]
+
+    def aclassify(self, point=None, k=1, dist=None, prbout=0):
+        """
+        Asynchronous classify(), see KNN.aclassify(). Each micro-batch is
+        one round trip to the shards.
+        """
+        if self.batcher is None:
+            import aioknn
+            self.batcher = aioknn.MicroBatcher(self)
+        return self.batcher.classify(point, k, dist, prbout)
+
+    def close(self):
+        """
+        Stops all shard processes.
+        """
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        for process, conn in self.shards:
+            try:
+                conn.send_bytes(dill.dumps(('close', None)))
+            except (IOError, OSError):
+                pass
+            conn.close()
+        for process, conn in self.shards:
+            process.join()
+        self.shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return sum(sum(c.values()) for c in self.shard_counts)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the asyncio front end.
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aioknn
+import knn
+import shard
+from test_knn import blobs
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data, self.label = blobs(60, 4)
+        self.queries, self.truth = blobs(10, 4, seed=1)
+        self.model = knn.KNN(self.data, self.label, dimensions=4)
+        self.expected = [self.model.classify(q, 3) for q in self.queries]
+
+    def test_flush_by_size(self):
+        batcher = aioknn.MicroBatcher(self.model, max_batch=4, max_delay=60)
+
+        async def main():
+            futures = [batcher.classify(q, 3) for q in self.queries[:8]]
+            # both batches started without waiting for the timer
+            self.assertEqual(batcher.stats['queue_depth'], 0)
+            self.assertEqual(batcher.stats['in_flight'], 8)
+            return await asyncio.gather(*futures)
+
+        self.assertEqual(run(main()), self.expected[:8])
+        self.assertEqual(batcher.stats['batches'], 2)
+        self.assertEqual(batcher.stats['max_batch_size'], 4)
+
+    def test_flush_by_timer(self):
+        batcher = aioknn.MicroBatcher(self.model, max_batch=64,
+                                      max_delay=0.01)
+
+        async def main():
+            futures = [batcher.classify(q, 3) for q in self.queries]
+            self.assertEqual(batcher.stats['queue_depth'], 10)
+            self.assertEqual(batcher.stats['batches'], 0)
+            self.assertEqual(batcher.mean_batch_size(), 0.)
+            return await asyncio.gather(*futures)
+
+        self.assertEqual(run(main()), self.expected)
+        self.assertEqual(batcher.stats['batches'], 1)
+        self.assertEqual(batcher.stats['last_batch_size'], 10)
+
+    def test_stats(self):
+        batcher = aioknn.MicroBatcher(self.model, max_batch=3, max_delay=60)
+
+        async def main():
+            futures = [batcher.classify(q, 3) for q in self.queries[:7]]
+            # two batches in flight, one request waiting
+            self.assertEqual(batcher.stats['queue_depth'], 1)
+            self.assertEqual(batcher.mean_batch_size(), 3.)
+            batcher._flush((3, None, 0))
+            return await asyncio.gather(*futures)
+
+        run(main())
+        self.assertEqual(batcher.stats['requests'], 7)
+        self.assertEqual(batcher.stats['in_flight'], 0)
+        self.assertEqual(batcher.mean_batch_size(), 7 / 3.)
+
+    def test_bad_request(self):
+        batcher = aioknn.MicroBatcher(self.model, max_batch=6, max_delay=60)
+
+        async def main():
+            futures = [batcher.classify(q, 3) for q in self.queries[:5]]
+            futures.append(batcher.classify({0: 'x'}, 3))
+            return await asyncio.gather(*futures, return_exceptions=True)
+
+        results = run(main())
+        self.assertEqual(results[:5], self.expected[:5])
+        self.assertIsInstance(results[5], TypeError)
+
+    def test_processes(self):
+        batcher = aioknn.MicroBatcher(self.model, max_batch=6, max_delay=0.01,
+                                      processes=2)
+
+        async def main():
+            futures = [batcher.classify(q, 3) for q in self.queries]
+            futures.append(batcher.classify({0: 'x'}, 3))
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            batcher.close()
+            return results
+
+        results = run(main())
+        self.assertEqual(results[:10], self.expected)
+        self.assertIsInstance(results[10], TypeError)
+
+    def test_add_closes_batcher(self):
+        point = dict((axis, 50.) for axis in range(4))
+
+        async def main():
+            self.assertEqual(await self.model.aclassify(point, 1),
+                             self.model.classify(point, 1))
+            self.model.add(point, 9)
+            self.assertIsNone(self.model.batcher)
+            result = await self.model.aclassify(point, 1)
+            self.model.close()
+            return result
+
+        self.assertEqual(run(main()), 9)
+        self.assertIsNone(self.model.batcher)
+
+
+class ShardedTest(unittest.TestCase):
+
+    def test_sharded(self):
+        data, label = blobs(60, 4)
+        queries, truth = blobs(10, 4, seed=1)
+        with shard.ShardedKNN(data, label, shards=2, dimensions=4) as model:
+            expected = [model.classify(q, 3) for q in queries]
+
+            async def main():
+                futures = [model.aclassify(q, 3) for q in queries]
+                futures.append(model.aclassify({0: 'x'}, 3))
+                return await asyncio.gather(*futures, return_exceptions=True)
+
+            results = run(main())
+            self.assertEqual(results[:10], expected)
+            self.assertIsInstance(results[10], RuntimeError)
+            # one batch, one round trip to the shards
+            self.assertEqual(model.batcher.stats['batches'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the streaming ingestion and spilling buffers.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dill
+import ingest
+import kdtree
+import knn
+from pointbuffer import PointBuffer
+from test_knn import blobs
+
+
+class SpillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        data, label = blobs(200, 5)
+        builder = ingest.Builder(5, 'int16', rerank=2, calibrate=50,
+                                 spill=os.path.join(self.tmp, 'train.buf'),
+                                 memory_limit=256)
+        builder.feed((p, l) for p, l in zip(data, label))
+        model = builder.build()
+        self.assertEqual(len(model.train_data), 200)
+        for i in (0, 57, 199):
+            for axis in range(5):
+                self.assertAlmostEqual(model.train_data.exact_point(i)[axis],
+                                       data[i][axis])
+
+        loaded = dill.loads(dill.dumps(model))
+        queries, truth = blobs(20, 5, seed=1)
+        self.assertEqual([loaded.classify(q, 3) for q in queries],
+                         [model.classify(q, 3) for q in queries])
+
+        # the buffer is frozen, adding goes to the spill file
+        point = dict((axis, 5.) for axis in range(5))
+        loaded.add(point, 7)
+        self.assertEqual(len(loaded.train_data), 201)
+        self.assertEqual(loaded.classify(point, 1), 7)
+
+    def test_npy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        path = os.path.join(self.tmp, 'train.npy')
+        numpy.save(path, numpy.array([[0., 1., 0], [2., 3., 1]]))
+        self.assertEqual(list(ingest.iter_npy(path)),
+                         [([0., 1.], 0.), ([2., 3.], 1.)])
+
+    def test_unfrozen_spill(self):
+        buf = PointBuffer(2, 'float32', spill=os.path.join(self.tmp, 'b'),
+                          memory_limit=4)
+        for i in range(5):
+            buf.append({0: float(i), 1: -float(i)})
+        # the first points are in the file, not mapped yet
+        self.assertRaises(ValueError, buf.value, 4, 0)
+        self.assertRaises(ValueError, dill.dumps, buf)
+        model = knn.KNN(buf, [0, 0, 1, 1, 1])
+        self.assertTrue(buf.frozen)
+        self.assertEqual(buf[4].to_dict(), {0: 4., 1: -4.})
+        self.assertEqual(model.classify({0: 3.9, 1: -3.9}, 1), 1)
+
+    def test_pickle_keeps_buffer(self):
+        buf = PointBuffer(2, 'float32', spill=os.path.join(self.tmp, 'b'))
+        buf.append({0: 1., 1: 2.})
+        loaded = dill.loads(dill.dumps(buf))
+        self.assertFalse(buf.frozen)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'b')))
+        self.assertEqual(loaded[0].to_dict(), {0: 1., 1: 2.})
+
+    def test_index_memory(self):
+        data, label = blobs(500, 8)
+        builder = ingest.Builder(8, 'int8',
+                                 spill=os.path.join(self.tmp, 'train.buf'))
+        builder.feed(zip(data, label))
+        model = builder.build()
+        # no object per point, 4 bytes per point for the tree
+        self.assertIsInstance(model.kdtree, kdtree.BufferTree)
+        self.assertEqual(len(model.kdtree.order), 500)
+        self.assertEqual(model.kdtree.order.itemsize, 4)
+
+    def test_csv(self):
+        path = os.path.join(self.tmp, 'train.csv')
+        with open(path, 'w') as f:
+            f.write('x,y,label\n0.5,1.5,1\n2,3,0\n\n')
+        samples = list(ingest.iter_csv(path, skip_header=True,
+                                       label_type=int))
+        self.assertEqual(samples, [([0.5, 1.5], 1), ([2., 3.], 0)])
+        samples = list(ingest.iter_csv(path, label_column=0,
+                                       skip_header=True))
+        self.assertEqual(samples, [([1.5, 1.], '0.5'), ([3., 0.], '2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
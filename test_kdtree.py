@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the kd-tree search.
+"""
+
+import copy
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import kdtree
+import Distance as ds
+from pointbuffer import PointBuffer
+from test_knn import sq_dist
+
+
+class SearchTest(unittest.TestCase):
+
+    def check_exact(self, points, dist, exact, k):
+        rnd = random.Random(1)
+        tree = kdtree.create(copy.deepcopy(points), 3)
+        for i in range(50):
+            query = dict((axis, rnd.random()) for axis in range(3))
+            expected = sorted(exact(p, query) for p in points)
+            kth = expected[k - 1]
+            found = [d for node, d in tree.search_knn(query, k, dist)]
+            self.assertEqual(found, [d for d in expected if d <= kth])
+
+    def points(self, digits=6):
+        rnd = random.Random(0)
+        return [dict((axis, round(rnd.random(), digits)) for axis in range(3))
+                for i in range(300)]
+
+    def test_squared_euclidean(self):
+        for k in (1, 4):
+            self.check_exact(self.points(), None, sq_dist, k)
+
+    def test_manhattan(self):
+        self.check_exact(self.points(), ds.ManhattanDistance,
+                         ds.ManhattanDistance, 4)
+
+    def test_ties(self):
+        # a coarse grid, many points at the same distance
+        self.check_exact(self.points(digits=1), ds.ManhattanDistance,
+                         ds.ManhattanDistance, 3)
+
+
+class BufferTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(0)
+        self.points = [dict((axis, rnd.random()) for axis in range(3))
+                       for i in range(500)]
+        self.buffer = PointBuffer(3, 'float64')
+        self.buffer.extend(self.points)
+
+    def check_exact(self, tree, points, dist, exact, k):
+        rnd = random.Random(1)
+        for i in range(50):
+            query = dict((axis, rnd.random()) for axis in range(3))
+            expected = sorted(exact(p, query) for p in points)
+            kth = expected[k - 1]
+            found = [d for node, d in tree.search_knn(query, k, dist)]
+            self.assertEqual(found, [d for d in expected if d <= kth])
+
+    def test_exact(self):
+        tree = kdtree.BufferTree(self.buffer)
+        for k in (1, 5):
+            self.check_exact(tree, self.points, None, sq_dist, k)
+        self.check_exact(tree, self.points, ds.ManhattanDistance,
+                         ds.ManhattanDistance, 3)
+
+    def test_partitioned_build(self):
+        limit = kdtree.SORT_LIMIT
+        kdtree.SORT_LIMIT = 8
+        try:
+            tree = kdtree.BufferTree(self.buffer)
+        finally:
+            kdtree.SORT_LIMIT = limit
+        self.assertEqual(sorted(tree.order), list(range(500)))
+        self.check_exact(tree, self.points, None, sq_dist, 4)
+
+    def test_add(self):
+        tree = kdtree.BufferTree(self.buffer)
+        rnd = random.Random(2)
+        points = list(self.points)
+        for i in range(20):
+            point = dict((axis, rnd.random()) for axis in range(3))
+            points.append(point)
+            node = tree.add(self.buffer.append(point))
+            self.assertEqual(node.index, 500 + i)
+        self.assertEqual(len(tree), 520)
+        self.check_exact(tree, points, None, sq_dist, 4)
+
+    def test_nodes(self):
+        tree = kdtree.BufferTree(self.buffer)
+        tree.add(self.buffer.append({0: 0.5, 1: 0.5, 2: 0.5}))
+        root = tree.nodes()
+        nodes = [node for node in kdtree.level_order(root)]
+        self.assertEqual(sorted(node.index for node in nodes),
+                         list(range(501)))
+        node, d = tree.search_knn(self.points[9], 1)[0]
+        self.assertEqual((node.index, d), (9, 0.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the KNN models.
+
+Run with `python -m unittest test_knn` or pytest from this directory.
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import knn
+
+
+def sq_dist(a, b):
+    return sum((a.get(axis, 0.) - b.get(axis, 0.))**2
+               for axis in range(len(a)))
+
+
+def blobs(n, dimensions, classes=3, spread=0.15, seed=0):
+    """
+    Returns (points, labels) of n points around one random center per class,
+    the centers are the same for every seed.
+    """
+    rnd = random.Random(-1)
+    centers = [[rnd.random() for axis in range(dimensions)]
+               for c in range(classes)]
+    rnd = random.Random(seed)
+    points, labels = [], []
+    for i in range(n):
+        c = i % classes
+        points.append(dict((axis, centers[c][axis] + rnd.gauss(0., spread))
+                           for axis in range(dimensions)))
+        labels.append(c)
+    return points, labels
+
+
+class CompactStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data, self.label = blobs(300, 6)
+        self.queries, self.truth = blobs(60, 6, seed=1)
+        self.model = knn.KNN(self.data, self.label, dimensions=6)
+        self.expected = [self.model.classify(q, 5) for q in self.queries]
+
+    def test_float32_matches_dict(self):
+        model = knn.KNN(self.data, self.label, dimensions=6,
+                        storage='float32')
+        self.assertEqual([model.classify(q, 5) for q in self.queries],
+                         self.expected)
+
+    def test_int8_rerank_matches_dict(self):
+        model = knn.KNN(self.data, self.label, dimensions=6, storage='int8',
+                        rerank=4)
+        found = [model.classify(q, 5) for q in self.queries]
+        same = sum(a == b for a, b in zip(found, self.expected))
+        self.assertGreaterEqual(same, 0.95 * len(self.queries))
+
+    def test_rerank_distances_are_exact(self):
+        model = knn.KNN(self.data, self.label, dimensions=6, storage='int8',
+                        rerank=4)
+        for q in self.queries[:10]:
+            for node, d in model.search_knn(q, 3):
+                p = self.data[model._sample_index(node)]
+                # from float32 coordinates
+                self.assertAlmostEqual(d, sq_dist(p, q), places=5)
+
+    def test_buffer_is_smaller(self):
+        model = knn.KNN(self.data, self.label, dimensions=6, storage='int8')
+        self.assertEqual(model.train_data.nbytes(), 300 * 6)
+        self.assertEqual(len(model.train_data), 300)
+
+    def test_rerank_copy(self):
+        # float32 re-ranks from its own values, int8 keeps a float32 copy
+        model = knn.KNN(self.data, self.label, dimensions=6,
+                        storage='float32', rerank=4)
+        self.assertEqual(model.train_data.nbytes(), 300 * 6 * 4)
+        model = knn.KNN(self.data, self.label, dimensions=6, storage='int8',
+                        rerank=4)
+        self.assertEqual(model.train_data.nbytes(), 300 * 6 * 5)
+
+    def test_one_based_keys(self):
+        data = [dict((axis + 1, v) for axis, v in p.items())
+                for p in self.data]
+        knn.KNN(data, self.label, dimensions=6)
+        self.assertRaises(ValueError, knn.KNN, data, self.label,
+                          dimensions=6, storage='int8')
+        model = knn.KNN(data, self.label, dimensions=7, storage='int8')
+        self.assertEqual(model.classify(data[4], 1), self.label[4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the LSH index.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import knn
+import lsh
+from test_knn import blobs, sq_dist
+
+
+class LSHTest(unittest.TestCase):
+
+    def recall(self, **params):
+        """
+        Returns the recall of the 10 nearest neighbors of an LSH index.
+        """
+        data, label = blobs(1000, 8, classes=5, spread=0.2)
+        queries, truth = blobs(50, 8, classes=5, spread=0.2, seed=1)
+        params.update(metric=2, seed=0)
+        model = knn.KNN(data, label, dimensions=8, index='lsh',
+                        index_params=params)
+        hits = 0
+        for q in queries:
+            neighbors = model.search_knn(q, 10)
+            self.assertGreaterEqual(len(neighbors), 10)
+            found = set(model._sample_index(node) for node, d in neighbors)
+            exact = sorted(range(len(data)),
+                           key=lambda i: sq_dist(data[i], q))[:10]
+            hits += len(found.intersection(exact))
+        return hits / 500.
+
+    def test_recall(self):
+        self.assertGreaterEqual(self.recall(tables=16, probes=8), 0.7)
+
+    def test_probes_raise_recall(self):
+        self.assertGreater(self.recall(probes=8), self.recall())
+
+    def test_too_few_candidates_scans(self):
+        data, label = blobs(50, 4)
+        model = knn.KNN(data, label, dimensions=4, index='lsh',
+                        index_params={'metric': 2, 'width': 16, 'seed': 0,
+                                      'bucket_width': 1e-3, 'max_probes': 2})
+        neighbors = model.search_knn(data[0], 3)
+        self.assertEqual(len(neighbors), 3)
+        self.assertEqual(neighbors[0][1], 0.)
+
+    def test_cosine(self):
+        data, label = blobs(200, 8)
+        model = knn.KNN(data, label, dimensions=8, index='lsh',
+                        index_params={'seed': 0})
+        self.assertEqual(model.classify(data[7], 1), label[7])
+
+
+class LSHIndexTest(unittest.TestCase):
+
+    def test_fit_bucket_width(self):
+        data, label = blobs(200, 4)
+        index = lsh.LSHIndex(4, metric=2, seed=0)
+        self.assertRaises(ValueError, index.add, data[0])
+        index.fit(data)
+        self.assertTrue(index.bucket_width > 0)
+        # a given width is kept
+        index = lsh.LSHIndex(4, metric=2, bucket_width=0.5, seed=0)
+        index.fit(data)
+        self.assertEqual(index.bucket_width, 0.5)
+
+    def test_probe_keys(self):
+        index = lsh.LSHIndex(4, metric=2, bucket_width=1., seed=0)
+        raw = index._project({0: 0.3, 1: 0.2, 2: 0.9, 3: 0.1}, 0)
+        keys = list(index._probe_keys(raw, 10))
+        self.assertEqual(len(keys), 11)
+        self.assertEqual(len(set(keys)), 11)
+        self.assertEqual(keys[0], index._key(raw))
+        # neighbouring buckets differ by one in every moved component
+        for key in keys[1:]:
+            self.assertTrue(all(abs(a - b) <= 1
+                                for a, b in zip(key, keys[0])))
+
+    def test_cosine_distance(self):
+        self.assertAlmostEqual(lsh.CosineDistance({0: 1., 1: 0.},
+                                                  {0: 2., 1: 0.}), 0.)
+        self.assertAlmostEqual(lsh.CosineDistance({0: 1., 1: 0.},
+                                                  {0: 0., 1: 3.}), 1.)
+        self.assertEqual(lsh.CosineDistance({0: 0., 1: 0.}, {0: 1.}), 1.)
+
+    def test_rerank_metric(self):
+        # with compact storage the re-rank uses the metric of the index
+        data, label = blobs(200, 4)
+        model = knn.KNN(data, label, dimensions=4, storage='int8', rerank=4,
+                        index='lsh', index_params={'metric': 1, 'seed': 0})
+        for node, d in model.search_knn(data[3], 3):
+            p = data[model._sample_index(node)]
+            self.assertAlmostEqual(
+                d, sum(abs(p[axis] - data[3][axis]) for axis in range(4)),
+                places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
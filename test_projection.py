@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the projections.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import dill
+import knn
+import shard
+from projection import GaussianProjection, PCAProjection, SparseProjection
+from test_knn import blobs, sq_dist
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data, self.label = blobs(300, 20)
+        self.queries, self.truth = blobs(20, 20, seed=1)
+
+    def test_rerank_distances(self):
+        model = knn.KNN(self.data, self.label, dimensions=20,
+                        projection=GaussianProjection(5, seed=0), rerank=5)
+        for q in self.queries:
+            neighbors = model.search_knn(q, 3)
+            for node, d in neighbors:
+                p = self.data[model._sample_index(node)]
+                self.assertAlmostEqual(d, sq_dist(p, q))
+            self.assertEqual([d for node, d in neighbors],
+                             sorted(d for node, d in neighbors))
+        # a training point finds itself
+        node, d = model.search_knn(self.data[3], 1)[0]
+        self.assertEqual(model._sample_index(node), 3)
+        self.assertEqual(d, 0.)
+
+    def test_pca_classifies(self):
+        model = knn.KNN(self.data, self.label, dimensions=20,
+                        projection=PCAProjection(3, seed=0), rerank=5)
+        found = [model.classify(q, 5) for q in self.queries]
+        self.assertGreaterEqual(
+            sum(map(lambda a, b: a == b, found, self.truth)), 18)
+
+    def test_shard_distances(self):
+        data, label = blobs(200, 12)
+        queries, truth = blobs(10, 12, seed=1)
+        with shard.ShardedKNN(data, label, shards=2, dimensions=12,
+                              projection=GaussianProjection(4, seed=0)) \
+                as model:
+            for q in queries:
+                for p, d, l in model.search_knn(q, 3):
+                    self.assertAlmostEqual(d, sq_dist(p, q))
+
+    def test_pickled_projection(self):
+        model = knn.KNN(self.data, self.label, dimensions=20,
+                        projection=GaussianProjection(5, seed=0), rerank=5)
+        loaded = dill.loads(dill.dumps(model))
+        self.assertEqual(loaded.projection.rows, model.projection.rows)
+        self.assertEqual([loaded.classify(q, 3) for q in self.queries],
+                         [model.classify(q, 3) for q in self.queries])
+
+    def test_saveknn(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'model.pkl')
+            model = knn.KNN(self.data, self.label, dimensions=20,
+                            projection=GaussianProjection(5, seed=0),
+                            rerank=5)
+            knn.saveknn(model, path)
+            loaded = knn.loadknn(path)
+            self.assertEqual(loaded.projection.rows, model.projection.rows)
+            self.assertEqual([loaded.classify(q, 3) for q in self.queries],
+                             [model.classify(q, 3) for q in self.queries])
+
+            # the default sel_axis of a plain model is a lambda
+            model = knn.KNN(self.data, self.label, dimensions=20)
+            knn.saveknn(model, path)
+            loaded = knn.loadknn(path)
+            self.assertEqual([loaded.classify(q, 3) for q in self.queries],
+                             [model.classify(q, 3) for q in self.queries])
+        finally:
+            shutil.rmtree(tmp)
+
+
+class RandomProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        # not the seed of the projections, their weights would be the points
+        rnd = random.Random(100)
+        self.points = [dict((axis, rnd.gauss(0., 1.)) for axis in range(100))
+                       for i in range(20)]
+
+    def check_distances(self, projection):
+        """
+        The squared distances are kept on average.
+        """
+        projection.fit(self.points, 100)
+        ratios = []
+        for a, b in zip(self.points, self.points[1:]):
+            pa = dict(enumerate(projection.transform(a)))
+            pb = dict(enumerate(projection.transform(b)))
+            ratios.append(sq_dist(pa, pb) / sq_dist(a, b))
+        self.assertTrue(0.8 < sum(ratios) / len(ratios) < 1.2)
+
+    def test_gaussian(self):
+        self.check_distances(GaussianProjection(60, seed=0))
+
+    def test_sparse(self):
+        projection = SparseProjection(60, seed=0)
+        self.check_distances(projection)
+        # density 1 / sqrt(100), most weights are 0
+        weights = sum(len(row) for row in projection.rows)
+        self.assertTrue(weights < 0.2 * 60 * 100)
+        self.assertEqual(set(abs(w) for row in projection.rows
+                             for axis, w in row),
+                         set([(1.0 / (0.1 * 60))**0.5]))
+
+    def test_seed(self):
+        a = SparseProjection(5, density=0.5, seed=3).fit(self.points, 100)
+        b = SparseProjection(5, density=0.5, seed=3).fit(self.points, 100)
+        self.assertEqual(a.rows, b.rows)
+
+    def test_pca_direction(self):
+        rnd = random.Random(1)
+        points = [{0: rnd.gauss(0., 5.), 1: rnd.gauss(0., 0.1),
+                   2: rnd.gauss(0., 0.1)} for i in range(200)]
+        projection = PCAProjection(1, seed=0).fit(points, 3)
+        weights = dict(projection.rows[0])
+        self.assertAlmostEqual(abs(weights[0]), 1., places=3)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the prototype reduction.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import knn
+from test_knn import blobs, sq_dist
+
+
+def consistency(model, reduced):
+    """
+    Returns the fraction of the training samples of model the samples of
+    reduced classify right with exact 1-NN.
+    """
+    kept = [(reduced._point(i), reduced.train_label[i])
+            for i in range(len(reduced.train_label))]
+    right = 0
+    for i, label in enumerate(model.train_label):
+        point = model._point(i)
+        nearest = min(kept, key=lambda s: sq_dist(s[0], point))
+        right += nearest[1] == label
+    return right / float(len(model.train_label))
+
+
+class ReduceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data, self.label = blobs(240, 4, spread=0.1)
+        self.model = knn.KNN(self.data, self.label, dimensions=4)
+
+    def check_report(self, method, k=3):
+        model, report = self.model.reduce(method, k)
+        self.assertEqual(report['method'], method)
+        self.assertEqual(report['k_before'], k)
+        self.assertEqual(report['original'], 240)
+        self.assertEqual(report['retained'], len(model.train_label))
+        self.assertAlmostEqual(report['retained_fraction'],
+                               report['retained'] / 240.)
+        for key in ('accuracy_before', 'accuracy_after', 'agreement'):
+            self.assertTrue(0. <= report[key] <= 1.)
+        return model, report
+
+    def test_cnn(self):
+        # the condensed set classifies all training samples right with 1-NN
+        model, report = self.check_report('cnn', k=1)
+        self.assertLess(report['retained'], 240)
+        self.assertEqual(report['accuracy_after'], 1.)
+
+    def test_cnn_overlapping(self):
+        data, label = blobs(300, 4, spread=0.25)
+        model = knn.KNN(data, label, dimensions=4)
+        reduced, report = model.reduce('cnn', k=1)
+        self.assertEqual(report['accuracy_after'], 1.)
+        self.assertEqual(consistency(model, reduced), 1.)
+
+    def test_cnn_compact_lsh(self):
+        data, label = blobs(120, 4, spread=0.25)
+        model = knn.KNN(data, label, dimensions=4, storage='int8', rerank=4,
+                        index='lsh', index_params={'metric': 2, 'seed': 0})
+        reduced, report = model.reduce('cnn', k=3)
+        self.assertEqual(consistency(model, reduced), 1.)
+
+    def test_condensed_evaluated_with_1nn(self):
+        model, report = self.check_report('enn+cnn')
+        self.assertEqual(report['k_after'], 1)
+
+    def test_enn(self):
+        model, report = self.check_report('enn')
+        self.assertEqual(report['k_after'], 3)
+        self.assertGreaterEqual(report['agreement'], 0.95)
+
+    def test_enn_drops_noise(self):
+        # one mislabeled sample in the middle of its class
+        label = list(self.label)
+        label[0] = 1
+        model = knn.KNN(self.data, label, dimensions=4)
+        reduced, report = model.reduce('enn', k=3)
+        self.assertLess(report['retained'], 240)
+        self.assertNotIn(self.data[0], reduced.train_data)
+
+    def test_enn_cnn_test_data(self):
+        queries, truth = blobs(30, 4, spread=0.1, seed=1)
+        model, report = self.model.reduce('enn+cnn', k=3, test_data=queries,
+                                          test_label=truth)
+        self.assertEqual(report['agreement'],
+                         sum(self.model.classify(q, 3) == model.classify(q, 1)
+                             for q in queries) / 30.)
+
+    def test_duplicates(self):
+        data = self.data + [dict(self.data[0])]
+        model = knn.KNN(data, self.label + [self.label[0]], dimensions=4)
+        reduced, report = model.reduce('enn', k=3)
+        self.assertEqual(report['original'], 241)
+
+    def test_bad_method(self):
+        self.assertRaises(ValueError, self.model.reduce, 'knn')
+
+
+if __name__ == '__main__':
+    unittest.main()
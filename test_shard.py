@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Behavior checks of the sharded model.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import knn
+import shard
+from pointbuffer import PointBuffer
+from test_knn import blobs, sq_dist
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_merge(self):
+        a = [({0: 0.}, 0.1, 'a'), ({0: 1.}, 0.4, 'a')]
+        b = [({0: 2.}, 0.2, 'b'), ({0: 3.}, 0.4, 'b')]
+        self.assertEqual([d for p, d, l in shard.merge([a, b], 2)],
+                         [0.1, 0.2])
+        # ties at the k-th distance are kept
+        self.assertEqual([d for p, d, l in shard.merge([a, b], 3)],
+                         [0.1, 0.2, 0.4, 0.4])
+
+    def test_merges_shard_results(self):
+        data, label = blobs(200, 4)
+        queries, truth = blobs(20, 4, seed=1)
+        # the models of the shards, built here
+        local = [knn.KNN(data[i::3], label[i::3], dimensions=4)
+                 for i in range(3)]
+        with shard.ShardedKNN(data, label, shards=3, dimensions=4) as model:
+            self.assertEqual(len(model), 200)
+            found = model.search_batch(queries, 5)
+            for q, neighbors in zip(queries, found):
+                expected = shard.merge(
+                    [[(m._point(m._sample_index(node)), d,
+                       m.train_label[m._sample_index(node)])
+                      for node, d in m.search_knn(q, 5)] for m in local], 5)
+                self.assertEqual(neighbors, expected)
+                for p, d, l in neighbors:
+                    self.assertAlmostEqual(d, sq_dist(p, q))
+                # the shards search exactly, so does the merge
+                self.assertEqual([d for p, d, l in neighbors],
+                                 sorted(sq_dist(p, q) for p in data)[:5])
+            self.assertEqual(model.classify_batch(queries, 5),
+                             [knn.vote(model.labels,
+                                       [l for p, d, l in neighbors])[0][0]
+                              for neighbors in found])
+
+    def test_sources(self):
+        data, label = blobs(90, 4)
+        parts = [list(zip(data[i::2], label[i::2])) for i in range(2)]
+        sources = [lambda part=part: part for part in parts]
+        with shard.ShardedKNN(sources=sources, dimensions=4,
+                              storage='int8', rerank=4) as model:
+            self.assertEqual(len(model), 90)
+            model.add(data[0], 2)
+            self.assertEqual(len(model), 91)
+            self.assertEqual(model.search_knn(data[5], 1)[0][2], label[5])
+
+    def test_point_buffer(self):
+        data, label = blobs(90, 4)
+        buf = PointBuffer(4, 'int8', exact=True)
+        buf.fit(data)
+        buf.extend(data)
+        with shard.ShardedKNN(buf, label, shards=2, rerank=4) as model:
+            self.assertEqual(len(model), 90)
+            p, d, l = model.search_knn(data[7], 1)[0]
+            self.assertEqual(l, label[7])
+            self.assertAlmostEqual(d, 0., places=5)
+
+    def test_add_shard(self):
+        data, label = blobs(150, 4)
+        with shard.ShardedKNN(data[:100], label[:100], shards=2,
+                              dimensions=4) as model:
+            n = model.add_shard(data[100:], label[100:])
+            self.assertEqual(n, 2)
+            self.assertEqual(len(model), 150)
+            p, d, l = model.search_knn(data[120], 1)[0]
+            self.assertEqual((d, l), (0., label[120]))
+
+    def test_rebuild_shard(self):
+        data, label = blobs(100, 4)
+        extra, extra_label = blobs(30, 4, seed=1)
+        with shard.ShardedKNN(data, label, shards=2, dimensions=4) as model:
+            # shard 0 holds the even samples
+            model.rebuild_shard(
+                0, source=lambda: list(zip(extra, extra_label)))
+            self.assertEqual(len(model), 80)
+            self.assertEqual(model.search_knn(extra[3], 1)[0][1], 0.)
+            self.assertTrue(model.search_knn(data[0], 1)[0][1] > 0.)
+            self.assertEqual(model.search_knn(data[1], 1)[0][1], 0.)
+
+    def test_lsh_index(self):
+        data, label = blobs(200, 6)
+        queries, truth = blobs(10, 6, seed=1)
+        with shard.ShardedKNN(data, label, shards=2, dimensions=6,
+                              index='lsh',
+                              index_params={'metric': 2, 'seed': 0}) as model:
+            for q in queries:
+                neighbors = model.search_knn(q, 3)
+                self.assertTrue(len(neighbors) >= 3)
+                for p, d, l in neighbors:
+                    # the Euclidean metric of the index
+                    self.assertAlmostEqual(d, sq_dist(p, q)**0.5)
+            self.assertEqual(model.search_knn(data[11], 1)[0][2], label[11])
+
+    def test_shard_error(self):
+        data, label = blobs(20, 4)
+        with shard.ShardedKNN(data, label, shards=2, dimensions=4) as model:
+            self.assertRaises(RuntimeError, model.search_knn, {0: 'x'}, 1)
+            # the pipes are still in sync
+            self.assertEqual(model.search_knn(data[2], 1)[0][1], 0.)
+
+
+if __name__ == '__main__':
+    unittest.main()